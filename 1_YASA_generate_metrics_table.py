@@ -1,105 +1,43 @@
 #Computes metrics averaged over classes in each subject:
-#avg_recall (this is derived from  classification_report())
+#avg_recall (macro average over the classes of the confusion matrix)
 #avg_PPV aka Positive Predictive Value (PPV)
 #avg_fpr, TP, FP, FN, TN aka false_positive_rate, true positives,
 #false positives, false negatives, true negatives
-#those metrics are stored in a table with a row representing one subject
+#those metrics are stored in a table with a row representing one subject,
+#the mean over the subjects (Среднее) and the metrics of the pooled cohort (Всего)
+#95% bootstrap intervals of Среднее and Всего (subjects resampled; optionally blocks of epochs resampled within
+#the subjects) are added as rows, with kappa in Total_metrics_ci_yasa_test.xlsx
+#Per-subject metrics go to the cohort store, --from-store takes the classifications from it
+#instead of preprocessing and staging the recordings
+#--random-baseline also stores the chance level of the metrics in Random_baseline_yasa.xlsx
+#Same as: python sleep.py run metrics (see pipeline.run_metrics), folders are taken from --config
 
-import os
-import numpy as np
-import pandas as pd
-import re
-from sklearn.metrics import classification_report
 import warnings
 warnings.filterwarnings("ignore")
-from functions import (preprocessing, prepare_data_for_hypnogram,
-                       yasa_staging, average_recall,average_PPV,
-                      average_false_positive_rate, compare_annotations)
-
-folder_data =  r'C:\Users\msasha\PycharmProjects\Sleep\data\haaglanden-medisch-centrum-sleep-staging-database-1.1\recordings'
-folder_pics_path = r"C:\Users\msasha\PycharmProjects\Sleep\pics"
-folder_metrics_path = r"C:\Users\msasha\PycharmProjects\Sleep\yasa_annotations_metrics"
-
-os.makedirs(folder_pics_path, exist_ok=True)
-os.makedirs(folder_metrics_path, exist_ok=True)
-
-columns = ["ID записи", "TP", "FP", "FN", "TN" , "Чувствительность Se (R)", "Специфичность P(PPV)",
-           "Доля ложных распознаваний FPR", "Точность: Matches Yasa & Doctor/Total"]
-df = pd.DataFrame(columns=columns)
-
-for idx in range(1, 2):
-    if idx < 10:
-        subject = "SN00{}".format(idx)
-    elif idx > 9 and idx < 100:
-        subject = "SN0{}".format(idx)
-    else:
-        assert(idx > 99)
-        subject = "SN{}".format(idx)
-
-    fname_edf = os.path.join(folder_data, f"{subject}.edf")
-    #Get and process the data (channels, resampling, filter)
-    try:
-        [raw, chan, sf] = preprocessing(fname_edf)
-    except Exception as FileNotFoundError:
-        print(f"Error processing file {fname_edf}: {FileNotFoundError}")
-        continue
-
-    #Mapping
-    # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
-    fname_txt = folder_data + "\{}_sleepscoring.txt".format(subject)
-    doctor_hypno_scoring = prepare_data_for_hypnogram(fname_txt, folder_metrics_path, subject)
-    #Automatic sleep staging with YASA
-    fname_pics = folder_pics_path + "\hypnogram_{}_yasa.png".format(subject)
-    hypno_predicted = yasa_staging(fname_pics, raw)
-
-    #Костыль
-    if len(hypno_predicted) > len(doctor_hypno_scoring):
-        hypno_pred = hypno_predicted[:-1]
-    else:
-        hypno_pred = hypno_predicted
-
-    # Metrics
-    doctor_hypno_scoring = doctor_hypno_scoring.astype(int)
-    report = classification_report(doctor_hypno_scoring, hypno_pred, output_dict=True)
-    # "Sensitivity"  in ГОСТ P MЭК 60601 2-47-2017 (tp/(tp + fn)) = Recall
-    #https://pmc.ncbi.nlm.nih.gov/articles/PMC10529246/https://pmc.ncbi.nlm.nih.gov/articles/PMC10529246/
-    avg_recall = average_recall(report)
-    #"Specificity" in ГОСТ P MЭК 60601 2-47-2017 (tp/(tp + fp)) = Precision, ie Positive Predictive Value (PPV)
-    # https://pmc.ncbi.nlm.nih.gov/articles/PMC8993826/
-    avg_PPV = average_PPV(doctor_hypno_scoring, hypno_pred)
-    # FPR
-    [avg_fpr, TP, FP, FN, TN] = average_false_positive_rate(doctor_hypno_scoring, hypno_pred)
-    # Cmp accuracy: hits of yasa and doctor / total
-    manual_acc = compare_annotations(folder_metrics_path, subject)
-
-    # Table
-    ID = re.sub(r'[A-Za-z]', '', subject)
-    averaged_row = [ID,  TP, FP, FN, TN, avg_recall, avg_PPV, avg_fpr, manual_acc]
-    df.loc[len(df)] = averaged_row
-    print(df)
-
-# Means for the table
-#TP, FP, FN, TN
-cols_to_round_0 = df.columns[1:5]
-# "Чувствительность Se (R)", "Специфичность P(PPV)",
-# "Доля ложных распознаваний FPR", "Точность: Matches Yasa & Doctor/Total"
-cols_to_round_2 = df.columns[5:]
-
-df[cols_to_round_0] = df[cols_to_round_0].astype(float).round(0)
-df[cols_to_round_2] = df[cols_to_round_2].astype(float).round(2)
-
-means = df[cols_to_round_0].mean().round(0).astype(int)
-means2 = df[cols_to_round_2].mean().round(2)
-
-#Mean
-mean_result = ['Среднее']
-mean_result += list(means)
-mean_result += list(means2)
-
-print(mean_result)
-# Добавляем строку в DataFrame
-df.loc[len(df)] = mean_result
-
-# Save in Excel
-yasa_metrics_path = os.path.join(folder_metrics_path, "Total_metrics_report_yasa_test.xlsx")
-df.to_excel(yasa_metrics_path, index=False)
\ No newline at end of file
+from functions import (subject_name, runner_arguments, add_render_arguments, add_instrumentation_arguments,
+                       add_staging_arguments, staging_channels, configure_instrumentation)
+from pipeline import load_config, run_metrics
+
+
+if __name__ == "__main__":
+    parser = runner_arguments("Metrics table of YASA vs doctor's annotations")
+    parser.add_argument("--config", help="JSON config with the folders (default: sleep.json if present)")
+    add_instrumentation_arguments(parser)
+    add_staging_arguments(parser)
+    parser.add_argument("--parquet", action="store_true", help="also save the table as Parquet")
+    parser.add_argument("--from-store", action="store_true",
+                        help="take the classifications from the cohort store instead of the recordings")
+    parser.add_argument("--bootstrap", type=int, default=10000, help="subject-level bootstrap resamples (0 - none)")
+    parser.add_argument("--block-bootstrap", type=int, default=0,
+                        help="epoch-block bootstrap resamples (0 - none), computed in --jobs processes")
+    parser.add_argument("--block-epochs", type=int, default=20, help="epochs per block of the epoch-block bootstrap")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the bootstrap and of the random baseline")
+    parser.add_argument("--random-baseline", action="store_true",
+                        help="also compute the chance level of the metrics (Random_baseline_yasa.xlsx)")
+    args = add_render_arguments(parser).parse_args()
+    configure_instrumentation(args.run_log, args.profile_dir)
+    subjects = [subject_name(idx) for idx in range(args.first, args.last + 1)]
+    run_metrics(load_config(args.config), subjects, from_store=args.from_store, jobs=args.jobs,
+                render_jobs=args.render_jobs, preset=args.preset, bootstrap=args.bootstrap,
+                block_bootstrap=args.block_bootstrap, block_epochs=args.block_epochs, seed=args.seed,
+                parquet=args.parquet, random_baseline=args.random_baseline, staging=staging_channels(args))
@@ -1,58 +1,26 @@
 #Derives and stores sleep statistics (Time in bed, Latency N1-3/REM, Share of N1-3/REM, Sleep efficicency
-# for each subject from YASA package in {subject}_sleep_statistics.json"
+# for each subject in {subject}_sleep_statistics.json (same values as yasa.sleep_statistics),
+# the doctor's and YASA statistics side by side in cohort_sleep_statistics.xlsx
+# and in the per-subject table of the cohort store; --from-store takes the hypnograms from the store
+#Only the hypnograms are needed: the doctor's scoring and the YASA staging stored by script 0
+#Both statistics cover the same epochs: those scored by the doctor and YASA (see pipeline._statistics_hypnograms)
+#Same as: python sleep.py run stats (see pipeline.run_stats), folders are taken from --config
 
-import os
-import numpy as np
-import pandas as pd
 import warnings
 warnings.filterwarnings("ignore")
-from functions import (preprocessing, prepare_data_for_hypnogram, plot_hypnogram,
-                      plot_spectrogram, yasa_staging, compare_annotations)
-import yasa
-from yasa import sleep_statistics
-import json
-
-import warnings
-warnings.filterwarnings("ignore")
-from functions import (preprocessing, prepare_data_for_hypnogram, plot_hypnogram,
-                      plot_spectrogram, yasa_staging, compare_annotations)
-
-folder_data =  r'C:\Users\msasha\PycharmProjects\Sleep\data\haaglanden-medisch-centrum-sleep-staging-database-1.1\recordings'
-folder_statistics_path = r"C:\Users\msasha\PycharmProjects\Sleep\sleep_statistics"
-
-for idx in range(1, 155):
-    if idx < 10:
-        subject = "SN00{}".format(idx)
-    elif idx > 9 and idx < 100:
-        subject = "SN0{}".format(idx)
-    else:
-        assert(idx > 99)
-        subject = "SN{}".format(idx)
-
-    fname_edf = os.path.join(folder_data, f"{subject}.edf")
-    # Get and process the data (channels, resampling, filter)
-    try:
-        [raw, chan, sf] = preprocessing(fname_edf)
-    except Exception as FileNotFoundError:
-        print(f"Error processing file {fname_edf}: {FileNotFoundError}")
-        continue
-
-    # Mapping
-    # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
-    fname_txt = folder_data + "\{}_sleepscoring.txt".format(subject)
-    hypno_filtered = prepare_data_for_hypnogram(fname_txt, subject)
-
-    # Only integers for sleep stages needed
-    hypno_filtered = hypno_filtered.iloc[1:]
-    hypno_numeric = hypno_filtered.astype(int)
-
-    # Assuming that we have one-value per 30-second.
-    stat = sleep_statistics(hypno_numeric, sf_hyp=1/30)
-
-    fname_stat = folder_statistics_path + "\{}_sleep_statistics.json".format(subject)
-    # JSON
-    with open(fname_stat, 'w', encoding='utf-8') as f:
-        json.dump(stat, f, ensure_ascii=False, indent=4)
-
-    print(f"Статистика сохранена в {fname_stat}")
-
+from functions import (subject_name, runner_arguments, add_instrumentation_arguments, add_staging_arguments,
+                       staging_channels, configure_instrumentation)
+from pipeline import load_config, run_stats
+
+
+if __name__ == "__main__":
+    parser = runner_arguments("Sleep statistics of the doctor's and YASA hypnograms")
+    parser.add_argument("--config", help="JSON config with the folders (default: sleep.json if present)")
+    add_instrumentation_arguments(parser)
+    parser.add_argument("--from-store", action="store_true",
+                        help="take the hypnograms from the cohort store instead of the scoring files")
+    args = add_staging_arguments(parser).parse_args()
+    configure_instrumentation(args.run_log, args.profile_dir)
+    subjects = [subject_name(idx) for idx in range(args.first, args.last + 1)]
+    run_stats(load_config(args.config), subjects, from_store=args.from_store, jobs=args.jobs,
+              staging=staging_channels(args))
@@ -0,0 +1,225 @@
+#Benchmark of every stage of the pipeline on synthetic recordings (see fixtures.py):
+#python benchmarks/bench_pipeline.py --hours 8 --channels 8 --save mne17_yasa065
+#python benchmarks/bench_pipeline.py --hours 8 --channels 8 --compare mne17_yasa065
+#Each case runs in its own process: wall time of the best of --repeat runs (setup excluded),
+#peak RSS of the process and epochs/s. Baselines are JSON files in benchmarks/baselines;
+#--compare exits with 1 when a case is more than --tolerance slower or bigger than the baseline.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import version, PackageNotFoundError
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import synthetic_recording, synthetic_cohort, EPOCH_SEC
+import functions
+import pipeline
+
+FOLDER_BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+PACKAGES = ["numpy", "scipy", "pandas", "mne", "yasa", "lightgbm", "antropy", "matplotlib", "fpdf2", "pyarrow"]
+
+def peak_rss_mb():
+    # Peak resident memory of this process
+    try:
+        import resource
+    except ImportError:  # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+# Every case: setup(ctx) -> state (not timed), run(ctx, state) -> number of epochs processed
+
+def _raw(ctx, picks=(functions.EEG_CHANNEL,)):
+    raw, _, _ = functions.preprocessing(ctx["edf"], picks=list(picks) if picks else None)
+    return raw
+
+def _n_epochs(raw):
+    return int(raw.n_times // (EPOCH_SEC * raw.info["sfreq"]))
+
+def _spectrogram(ctx, raw):
+    fname = os.path.join(ctx["scratch"], "spectrogram.npz")
+    functions.spectrogram_store(raw, fname)
+    return fname
+
+def _plot_spectrogram(ctx, state):
+    hypno, fname_spectrogram = state
+    functions.plot_spectrogram(os.path.join(ctx["scratch"], "spectrogram.png"), hypno, fname_spectrogram)
+    return len(hypno)
+
+# Default ensemble, and all the derivations of the recordings with EOG and EMG (needs --channels 7 or more)
+ENSEMBLE = dict(eeg_names=functions.STAGING_EEG_CHANNELS)
+ENSEMBLE_FULL = dict(eeg_names=functions.STAGING_EEG_DERIVATIONS, eog_name=functions.STAGING_EOG_CHANNEL,
+                     emg_name=functions.STAGING_EMG_CHANNEL)
+
+def _stage_statistics(ctx):
+    hypno = functions.prepare_data_for_hypnogram(ctx["txt"])[1:]
+    padded, lengths = functions.pad_hypnograms([hypno])
+    return functions.cohort_sleep_statistics(padded, lengths).iloc[0].to_dict()
+
+def _pdf_state(ctx):
+    hypno = functions.prepare_data_for_hypnogram(ctx["txt"])
+    fname_pics = os.path.join(ctx["scratch"], "spectrogram.png")
+    functions.plot_spectrogram(fname_pics, hypno, _spectrogram(ctx, _raw(ctx)))
+    return _stage_statistics(ctx), fname_pics, len(hypno)
+
+def _pdf(ctx, state):
+    stat, fname_pics, n_epochs = state
+    stat = {pipeline.descriptions.get(key, key): value for key, value in stat.items()}
+    pipeline.create_sleep_statistics_pdf("SN001", stat, os.path.join(ctx["scratch"], "report.pdf"), fname_pics,
+                                         ctx["font"])
+    return n_epochs
+
+def _metrics(ctx, state):
+    doctors, preds = state
+    cms = functions.cohort_confusion(doctors, preds)
+    functions.cohort_metrics_table(ctx["subjects"], cms)
+    functions.bootstrap_table(cms, n_boot=1000, seed=0)
+    return sum(len(doctor) for doctor in doctors)
+
+def _random_baseline(ctx, state):
+    doctors, preds = state
+    functions.cohort_random_baseline(ctx["subjects"], doctors, preds, n_shuffles=200, seed=0)
+    return sum(len(doctor) for doctor in doctors)
+
+def _sleep_statistics(ctx, state):
+    doctors, _ = state
+    padded, lengths = functions.pad_hypnograms(doctors)
+    functions.cohort_sleep_statistics(padded, lengths, index=ctx["subjects"])
+    return sum(len(doctor) for doctor in doctors)
+
+def _cohort(ctx):
+    return synthetic_cohort(len(ctx["subjects"]), ctx["epochs"], seed=0)
+
+CASES = {
+    "preprocessing": (lambda ctx: None, lambda ctx, state: _n_epochs(_raw(ctx))),
+    "preprocessing_all": (lambda ctx: None, lambda ctx, state: _n_epochs(_raw(ctx, picks=None))),
+    "parsing": (lambda ctx: None,
+                lambda ctx, state: len(functions.prepare_data_for_hypnogram(ctx["txt"], return_onsets=True)[0])),
+    "spectrogram": (_raw, lambda ctx, raw: functions.compute_spectrogram(
+        raw.get_data(picks=[functions.EEG_CHANNEL], units="uV")[0], raw.info["sfreq"]) and _n_epochs(raw)),
+    "staging": (_raw, lambda ctx, raw: len(functions.yasa_predict(raw)[0])),
+    "staging_ensemble": (lambda ctx: _raw(ctx, picks=functions.staging_picks(**ENSEMBLE)),
+                         lambda ctx, raw: len(functions.yasa_predict_ensemble(raw, **ENSEMBLE)[0])),
+    "staging_ensemble_full": (lambda ctx: _raw(ctx, picks=functions.staging_picks(**ENSEMBLE_FULL)),
+                              lambda ctx, raw: len(functions.yasa_predict_ensemble(raw, **ENSEMBLE_FULL)[0])),
+    "bandpower": (lambda ctx: _raw(ctx, picks=functions.STAGING_EEG_DERIVATIONS),
+                  lambda ctx, raw: functions.epoch_bandpower(raw, functions.STAGING_EEG_DERIVATIONS)[0].shape[1]),
+    "plot_hypnogram": (lambda ctx: functions.prepare_data_for_hypnogram(ctx["txt"]),
+                       lambda ctx, hypno: functions.plot_hypnogram(
+                           os.path.join(ctx["scratch"], "hypnogram.png"), hypno) or len(hypno)),
+    "plot_spectrogram": (lambda ctx: (functions.prepare_data_for_hypnogram(ctx["txt"]), _spectrogram(ctx, _raw(ctx))),
+                         _plot_spectrogram),
+    "metrics": (_cohort, _metrics),
+    "random_baseline": (_cohort, _random_baseline),
+    "sleep_statistics": (_cohort, _sleep_statistics),
+    "pdf": (_pdf_state, _pdf),
+}
+
+def run_case(name, ctx, repeat):
+    # Runs in a fresh process, see benchmark()
+    import matplotlib
+    matplotlib.use("Agg")
+    functions.mne.set_log_level("ERROR")
+    setup, run = CASES[name]
+    times = []
+    # Messages of the pipeline are not part of the report
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        state = setup(ctx)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            n_epochs = run(ctx, state)
+            times.append(time.perf_counter() - start)
+    wall = min(times)
+    return dict(wall_sec=wall, peak_rss_mb=peak_rss_mb(), epochs=int(n_epochs), epochs_per_sec=n_epochs / wall)
+
+def benchmark(cases, ctx, repeat=3):
+    # {case: result of run_case}; a spawned process per case so that the peak RSS and the imports are its own
+    results = {}
+    for name in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[name] = executor.submit(run_case, name, ctx, repeat).result()
+        print("{:<18}{wall_sec:9.3f} s {peak_rss_mb:9.1f} MB {epochs_per_sec:12.1f} epochs/s".format(
+            name, **results[name]))
+    return results
+
+def environment(params):
+    packages = {}
+    for package in PACKAGES:
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = None
+    return dict(params=params, python=platform.python_version(), platform=platform.platform(), packages=packages)
+
+def baseline_path(name):
+    # Name of a baseline in benchmarks/baselines or a path to a JSON file
+    return name if name.endswith(".json") else os.path.join(FOLDER_BASELINES, name + ".json")
+
+def compare(results, baseline, tolerance=0.25):
+    # Cases slower (wall time) or bigger (peak RSS) than the baseline by more than `tolerance`
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        for key in ["wall_sec", "peak_rss_mb"]:
+            ratio = result[key] / baseline["results"][name][key]
+            print(f"{name:<18}{key:<13}{ratio:7.2f}x")
+            if ratio > 1 + tolerance:
+                regressions.append((name, key, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages on synthetic recordings")
+    parser.add_argument("--hours", type=float, default=8, help="length of the synthetic recording")
+    parser.add_argument("--channels", type=int, default=8, help="channels of the synthetic recording")
+    parser.add_argument("--sfreq", type=int, default=256, help="sampling rate of the synthetic recording")
+    parser.add_argument("--subjects", type=int, default=154, help="subjects of the cohort of the metrics cases")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="cases to run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every case, the best one is reported")
+    parser.add_argument("--folder", help="folder of the synthetic recordings (default: a temporary folder)")
+    parser.add_argument("--font", help="TTF font of the PDF (default: DejaVu Sans of matplotlib)")
+    parser.add_argument("--save", help="save the results as a baseline (name in benchmarks/baselines or .json)")
+    parser.add_argument("--compare", help="compare with a baseline (name in benchmarks/baselines or .json)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown of --compare (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    params = dict(hours=args.hours, channels=args.channels, sfreq=args.sfreq, subjects=args.subjects)
+    folder = args.folder or tempfile.mkdtemp(prefix="sleep_bench_")
+    subject = "SYN_{hours:g}h_{channels}ch_{sfreq}Hz".format(**params)
+    fname_edf, fname_txt = synthetic_recording(folder, subject, args.hours, args.channels, args.sfreq)
+    if args.font is None:
+        import matplotlib
+        args.font = os.path.join(matplotlib.get_data_path(), "fonts", "ttf", "DejaVuSans.ttf")
+    scratch = os.path.join(folder, "scratch")
+    os.makedirs(scratch, exist_ok=True)
+    ctx = dict(edf=fname_edf, txt=fname_txt, font=args.font, scratch=scratch,
+               subjects=[functions.subject_name(idx) for idx in range(1, args.subjects + 1)],
+               epochs=int(args.hours * 3600 // EPOCH_SEC))
+
+    results = benchmark(args.cases, ctx, args.repeat)
+    report = dict(environment(params), results=results)
+    if args.save:
+        os.makedirs(FOLDER_BASELINES, exist_ok=True)
+        with open(baseline_path(args.save), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(baseline_path(args.compare), 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline["params"] != params:
+            print(f"Параметры отличаются от базовых: {baseline['params']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, ratio in regressions:
+            print(f"Регрессия: {name} {key} {ratio:.2f}x")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,95 @@
+#Synthetic polysomnography in the format of the Haaglanden recordings: {subject}.edf and
+#{subject}_sleepscoring.txt with a random hypnogram. The EEG power in the delta, theta, alpha,
+#sigma and beta bands follows the stage of every 30-sec epoch, so YASA finds more than wake.
+#Writing the EDF needs edfio (mne.export.export_raw).
+
+import os
+from bisect import bisect_right
+import numpy as np
+import scipy.signal as sp_sig
+import mne
+
+# Channels of the Haaglanden recordings, C4-M1 (EEG_CHANNEL) first
+CHANNELS = [("EEG C4-M1", "eeg"), ("EEG F4-M1", "eeg"), ("EEG C3-M2", "eeg"), ("EEG O2-M1", "eeg"),
+            ("EOG E1-M2", "eog"), ("EOG E2-M2", "eog"), ("EMG chin", "emg"), ("ECG", "ecg")]
+STAGE_LABELS = ["W", "N1", "N2", "N3", "R"]
+BANDS = [(0.5, 4), (4, 8), (8, 12), (12, 16), (16, 30)]
+# Amplitude (uV) of the delta, theta, alpha, sigma and beta EEG of each stage (W, N1, N2, N3, REM)
+STAGE_AMPLITUDES = np.array([[5, 4, 10, 2, 6],
+                             [8, 10, 4, 2, 3],
+                             [15, 8, 3, 8, 2],
+                             [40, 10, 2, 3, 1],
+                             [6, 10, 4, 1, 5]], dtype=float)
+# Stage of the next epoch: mostly the same, otherwise towards the neighbouring stages of a sleep cycle
+TRANSITIONS = np.array([[0.90, 0.08, 0.01, 0.00, 0.01],
+                        [0.04, 0.80, 0.14, 0.00, 0.02],
+                        [0.02, 0.02, 0.90, 0.04, 0.02],
+                        [0.01, 0.00, 0.05, 0.94, 0.00],
+                        [0.03, 0.02, 0.02, 0.00, 0.93]])
+EPOCH_SEC = 30
+
+def synthetic_hypnogram(n_epochs, rng):
+    # Markov chain of int8 stages (0 = W ... 4 = REM) starting awake
+    cumulative = TRANSITIONS.cumsum(axis=1).tolist()
+    draws = rng.random(n_epochs).tolist()
+    hypno = [0] * n_epochs
+    for i in range(1, n_epochs):
+        row = cumulative[hypno[i - 1]]
+        hypno[i] = min(bisect_right(row, draws[i]), 4)
+    return np.array(hypno, dtype=np.int8)
+
+def synthetic_signals(hypno, sfreq, ch_types, rng):
+    # (channels, samples) in volts: band-limited noise of every band scaled epoch by epoch
+    # with STAGE_AMPLITUDES for the EEG, broadband noise for the other channels
+    n_samples = len(hypno) * EPOCH_SEC * sfreq
+    data = np.empty((len(ch_types), n_samples))
+    for ch, ch_type in enumerate(ch_types):
+        if ch_type != "eeg":
+            data[ch] = rng.standard_normal(n_samples) * 10
+            continue
+        data[ch] = 0
+        for band, (l_freq, h_freq) in enumerate(BANDS):
+            sos = sp_sig.butter(4, [l_freq, h_freq], btype="bandpass", fs=sfreq, output="sos")
+            noise = sp_sig.sosfilt(sos, rng.standard_normal(n_samples))
+            noise /= noise.std()
+            data[ch] += noise * np.repeat(STAGE_AMPLITUDES[hypno, band], EPOCH_SEC * sfreq)
+    return data * 1e-6
+
+def write_sleepscoring(fname_txt, hypno):
+    # Scoring file of the Haaglanden recordings: lights off, one line per epoch, lights on
+    lines = ["Date, Time, Recording onset, Duration, Annotation, Linked channel\n",
+             "2001-01-01, 22:00:00, 0.0, 0.0, Lights off, \n"]
+    lines += [f"2001-01-01, 22:00:00, {i * float(EPOCH_SEC)}, {float(EPOCH_SEC)}, Sleep stage {STAGE_LABELS[stage]}, \n"
+              for i, stage in enumerate(hypno)]
+    lines.append(f"2001-01-01, 22:00:00, {len(hypno) * float(EPOCH_SEC)}, 0.0, Lights on, \n")
+    with open(fname_txt, 'w', encoding='utf-8') as f:
+        f.write("".join(lines))
+
+def synthetic_recording(folder, subject, hours=8, n_channels=8, sfreq=256, seed=0):
+    # Writes {subject}.edf and {subject}_sleepscoring.txt unless they are there; returns their paths.
+    # Channels beyond the 8 of CHANNELS are extra EEG channels.
+    fname_edf = os.path.join(folder, f"{subject}.edf")
+    fname_txt = os.path.join(folder, f"{subject}_sleepscoring.txt")
+    if os.path.exists(fname_edf) and os.path.exists(fname_txt):
+        return fname_edf, fname_txt
+    os.makedirs(folder, exist_ok=True)
+    channels = CHANNELS[:n_channels] + [(f"EEG X{i}-M1", "eeg") for i in range(n_channels - len(CHANNELS))]
+    rng = np.random.default_rng(seed)
+    hypno = synthetic_hypnogram(int(hours * 3600 // EPOCH_SEC), rng)
+    data = synthetic_signals(hypno, sfreq, [ch_type for _, ch_type in channels], rng)
+    info = mne.create_info([name for name, _ in channels], sfreq, [ch_type for _, ch_type in channels])
+    mne.export.export_raw(fname_edf, mne.io.RawArray(data, info, verbose=False), overwrite=True, verbose=False)
+    write_sleepscoring(fname_txt, hypno)
+    return fname_edf, fname_txt
+
+def synthetic_cohort(n_subjects, n_epochs, agreement=0.75, seed=0):
+    # Doctor's hypnograms of n_subjects and "predictions" that agree on `agreement` of the epochs,
+    # for the metrics and statistics that only need the labels
+    rng = np.random.default_rng(seed)
+    doctors, preds = [], []
+    for _ in range(n_subjects):
+        doctor = synthetic_hypnogram(n_epochs, rng)
+        pred = np.where(rng.random(n_epochs) < agreement, doctor, rng.integers(0, 5, n_epochs)).astype(np.int8)
+        doctors.append(doctor)
+        preds.append(pred)
+    return doctors, preds
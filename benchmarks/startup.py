@@ -0,0 +1,63 @@
+#Startup time of the pipeline: what a script or a worker process pays before its first subject.
+#Every case runs in a fresh interpreter (median of --repeat runs, interpreter start included):
+#python benchmarks/startup.py --repeat 5
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports of each stage: the shared library, then the libraries its first subject loads
+CASES = {
+    "python": "pass",
+    "import functions": "import functions",
+    "import pipeline": "import pipeline",
+    "sleep.py --help": "import sleep",
+    "report imports": "import pipeline; import fpdf, PIL.Image",
+    "stats imports": "import pipeline; pipeline.pd.DataFrame",
+    "metrics imports": "import pipeline; pipeline.pd.DataFrame; import sklearn.metrics",
+    "stage imports": "import pipeline; pipeline.pd.DataFrame; import mne, yasa, antropy, lspopt, matplotlib.pyplot",
+}
+
+# Spawned worker process: ProcessPoolExecutor start + import of pipeline for the first task
+POOL_WORKER = """
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pipeline
+start = time.perf_counter()
+with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+    executor.submit(pipeline.subject_name, 1).result()
+print(time.perf_counter() - start)
+"""
+
+def run_case(code):
+    # Wall time of a fresh interpreter running `code` in the repository folder
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=REPO, check=True,
+                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def run_pool_worker():
+    # Time from the start of the pool to the first result, measured inside the parent
+    out = subprocess.run([sys.executable, "-c", POOL_WORKER], cwd=REPO, check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+def startup_times(repeat=5):
+    # {case: median seconds}
+    times = {name: [run_case(code) for _ in range(repeat)] for name, code in CASES.items()}
+    times["spawned pool worker"] = [run_pool_worker() for _ in range(repeat)]
+    return {name: statistics.median(values) for name, values in times.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time of the pipeline scripts and workers")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every case (median is reported)")
+    args = parser.parse_args()
+    for name, seconds in startup_times(args.repeat).items():
+        print(f"{name:<22}{seconds:8.3f} s")
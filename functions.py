@@ -1,252 +1,1380 @@
 import os
+import sys
+import glob
+import argparse
+import hashlib
+import json
+import sqlite3
+import importlib.util
+import time
+import cProfile
+from functools import wraps
+from contextlib import closing, contextmanager, suppress
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import repeat, permutations
 import numpy as np
-import pandas as pd
-import mne
-import yasa
-import matplotlib.pyplot as plt
-from sklearn.metrics import confusion_matrix
-import random
-
-def read_annotations(file_path, file_type):
-    if file_type == 'txt':
-        with open(file_path, 'r') as f:
-            return [line.strip() for line in f.readlines() if line.strip()]
-    elif file_type == 'csv':
-        df = pd.read_csv(file_path)
-        return df['Annotation'].astype(str).tolist()
-
-def preprocessing(fname_edf):
-    #Polysomnography data
-    raw = mne.io.read_raw_edf(fname_edf, preload=True)
-
-    #Selecting channels
-    raw.drop_channels(["EMG chin", "EOG E1-M2", "EOG E2-M2", "ECG"])
-    chan = raw.ch_names
-
-    raw.resample(100)
+import re
+
+def lazy_import(name):
+    # Module imported on the first access to its attributes: importing functions stays cheap
+    # and every script or worker process only pays for the libraries of the stages it runs
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+pd = lazy_import("pandas")
+mne = lazy_import("mne")
+yasa = lazy_import("yasa")
+joblib = lazy_import("joblib")
+ant = lazy_import("antropy")
+sp_sig = lazy_import("scipy.signal")
+sp_stats = lazy_import("scipy.stats")
+sp_integrate = lazy_import("scipy.integrate")
+
+def subject_name(idx):
+    # 1 -> SN001, 154 -> SN154
+    return "SN{:03d}".format(idx)
+
+def runner_arguments(description):
+    # Common command line for the per-subject scripts
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of worker processes (subjects processed in parallel)")
+    parser.add_argument("--first", type=int, default=1, help="first subject index (SN001 = 1)")
+    parser.add_argument("--last", type=int, default=154, help="last subject index (SN154 = 154)")
+    return parser
+
+def _run_subject(process_subject, subject):
+    # One failing subject must not stop the whole batch
+    global _current_subject
+    _current_subject = subject
+    try:
+        # The whole subject is one record of the run log, its stages are recorded inside
+        with stage_timer(getattr(process_subject, "func", process_subject).__name__, subject, level="subject",
+                         profile=False):
+            return process_subject(subject)
+    except Exception as e:
+        print(f"Error processing subject {subject}: {e}")
+        return None
+    finally:
+        _current_subject = None
+
+def _gather(results, n_subjects, on_result):
+    # results: (index in subjects, result) pairs in the order the subjects finish
+    gathered = [None] * n_subjects
+    for index, result in results:
+        if on_result is not None and result is not None:
+            on_result(result)
+        gathered[index] = result
+    return gathered
+
+def run_subjects(process_subject, subjects, jobs=1, on_result=None):
+    # Runs process_subject(subject) for every subject, in `jobs` worker processes.
+    # Results are returned in the order of `subjects`; None for failed subjects.
+    # on_result(result) is called in the main process as soon as each subject is done, in the order
+    # they finish: a slow subject does not hold back the subjects after it.
+    # process_subject must be a module level function so that it can be pickled.
+    subjects = list(subjects)
+    if jobs <= 1 or len(subjects) <= 1:
+        return _gather(((index, _run_subject(process_subject, subject)) for index, subject in enumerate(subjects)),
+                       len(subjects), on_result)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_run_subject, process_subject, subject): index
+                   for index, subject in enumerate(subjects)}
+        return _gather(((futures[future], future.result()) for future in as_completed(futures)),
+                       len(subjects), on_result)
+
+# Run log: one JSON line per stage of every subject (see stage_timer), enabled by configure_instrumentation.
+# The settings are environment variables so that the worker processes inherit them.
+RUN_LOG_ENV = "SLEEP_RUN_LOG"
+PROFILE_DIR_ENV = "SLEEP_PROFILE_DIR"
+# Subject processed by this process, see _run_subject
+_current_subject = None
+# Only one cProfile profiler can be active, nested stages are in the dump of the outer one
+_profiling = False
+
+def add_instrumentation_arguments(parser):
+    parser.add_argument("--run-log", help="append the duration, memory and epochs of every stage to this JSONL file")
+    parser.add_argument("--profile-dir", help="also dump a cProfile (pstats) file of every stage to this folder")
+    return parser
+
+def configure_instrumentation(run_log=None, profile_dir=None):
+    # Turns the run log (and the profiles) on for this process and the workers it starts
+    for name, value in [(RUN_LOG_ENV, run_log), (PROFILE_DIR_ENV, profile_dir)]:
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = os.path.abspath(value)
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+def current_rss_mb():
+    # Resident memory of this process, None where it cannot be measured
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@contextmanager
+def stage_timer(stage, subject=None, epochs=None, level="stage", profile=True):
+    # Records the duration, the memory delta and the epochs of the block in the run log.
+    # level: "stage", or "subject" for the whole processing of a subject (see _run_subject).
+    # Yields a dict: the block can set record["epochs"] once it knows them.
+    # Does nothing unless configure_instrumentation turned the run log on.
+    global _profiling
+    record = dict(stage=stage, subject=subject if subject is not None else _current_subject, level=level,
+                  epochs=epochs)
+    fname_log = os.environ.get(RUN_LOG_ENV)
+    if fname_log is None:
+        yield record
+        return
+    profile_dir = os.environ.get(PROFILE_DIR_ENV)
+    profiler = None
+    if profile and profile_dir is not None and not _profiling:
+        profiler = cProfile.Profile()
+        _profiling = True
+    rss_start = current_rss_mb()
+    start = time.perf_counter()
+    record["ok"] = False
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield record
+        record["ok"] = True
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiling = False
+            fname_prof = os.path.join(profile_dir, "{}_{}.prof".format(record["subject"] or "cohort", stage))
+            profiler.dump_stats(fname_prof)
+            record["profile"] = fname_prof
+        record["duration_sec"] = time.perf_counter() - start
+        rss_end = current_rss_mb()
+        record["rss_mb"] = rss_end
+        record["rss_delta_mb"] = rss_end - rss_start if rss_end is not None and rss_start is not None else None
+        record.update(time=datetime.now().isoformat(timespec="seconds"), pid=os.getpid())
+        # One short line per write, appended by every process
+        with open(fname_log, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=int) + "\n")
+
+def instrumented(stage, epochs=None):
+    # Decorator: every call of the function is a stage_timer record;
+    # epochs(result) gives the number of epochs processed
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage) as record:
+                result = func(*args, **kwargs)
+                if epochs is not None and os.environ.get(RUN_LOG_ENV) is not None:
+                    record["epochs"] = epochs(result)
+                return result
+        return wrapper
+    return decorator
+
+def read_run_log(fname):
+    # Records of the run log as a DataFrame
+    return pd.read_json(fname, lines=True)
+
+def run_log_summary(fname, top=10):
+    # (stages, subjects, slowest records): time per stage over all subjects, total time per subject,
+    # the `top` slowest stage records
+    log = read_run_log(fname)
+    log["subject"] = log["subject"].fillna("cohort")
+    by_stage = log[log["level"] == "stage"]
+    grouped = by_stage.groupby("stage")
+    stages = grouped["duration_sec"].agg(["count", "sum", "mean", "max"])
+    stages["epochs_per_sec"] = grouped["epochs"].sum(min_count=1) / stages["sum"]
+    stages["rss_delta_mb"] = grouped["rss_delta_mb"].max()
+    stages = stages.sort_values("sum", ascending=False)
+    subjects = (log[log["level"] == "subject"].groupby("subject")["duration_sec"].sum()
+                .sort_values(ascending=False).head(top))
+    slowest = by_stage.nlargest(top, "duration_sec")[["subject", "stage", "duration_sec", "rss_delta_mb", "epochs"]]
+    return stages, subjects, slowest
+
+def add_manifest_arguments(parser):
+    # Incremental runs, see stage_is_fresh()
+    parser.add_argument("--force", action="store_true", help="recompute every stage, ignore the manifest")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted batch: skip every stage already recorded in the manifest")
+    return parser
+
+def stage_signature(inputs, params):
+    # Hash of the input files (path, size, modification time) and of the stage parameters
+    files = []
+    for fname in inputs:
+        st = os.stat(fname)
+        files.append([os.path.abspath(fname), st.st_size, st.st_mtime_ns])
+    return hashlib.sha1(json.dumps([files, params], sort_keys=True).encode()).hexdigest()
+
+def _open_manifest(fname_manifest):
+    # SQLite handles the concurrent writes of the worker processes
+    con = sqlite3.connect(fname_manifest, timeout=60)
+    con.execute("CREATE TABLE IF NOT EXISTS stages (subject TEXT, stage TEXT, signature TEXT, "
+                "outputs TEXT, result TEXT, updated TEXT, PRIMARY KEY (subject, stage))")
+    return con
+
+def stage_is_fresh(fname_manifest, subject, stage, signature, resume=False):
+    # Returns (True, stored result) when the stage was recorded with the same signature and
+    # all its outputs still exist. With resume any recorded stage counts, whatever its signature.
+    with closing(_open_manifest(fname_manifest)) as con:
+        row = con.execute("SELECT signature, outputs, result FROM stages WHERE subject = ? AND stage = ?",
+                          (subject, stage)).fetchone()
+    if row is None:
+        return False, None
+    recorded_signature, outputs, result = row
+    if not resume and recorded_signature != signature:
+        return False, None
+    if not all(os.path.exists(fname) for fname in json.loads(outputs)):
+        return False, None
+    return True, json.loads(result)
+
+def record_stage(fname_manifest, subject, stage, signature, outputs, result=None):
+    # Called once the stage outputs are written
+    with closing(_open_manifest(fname_manifest)) as con, con:
+        con.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                    (subject, stage, signature, json.dumps(list(outputs)), json.dumps(result),
+                     datetime.now().isoformat(timespec='seconds')))
+
+# Channels not used for staging
+DROP_CHANNELS = ["EMG chin", "EOG E1-M2", "EOG E2-M2", "ECG"]
+# The only channel needed by yasa_staging and plot_spectrogram
+EEG_CHANNEL = "EEG C4-M1"
+
+def file_hash(fname, chunk_size=1 << 20):
+    # sha1 of the file content, read by chunks
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _raw_epochs(raw):
+    # Number of 30-sec epochs of a recording, for the run log
+    return int(raw.n_times // (STAGING_EPOCH_SEC * raw.info["sfreq"]))
+
+def preprocessing(fname_edf, sfreq=100, l_freq=0.3, h_freq=45, cache_dir=None, picks=None, memmap_dir=None):
+    # picks: list of channels to decode (e.g. [EEG_CHANNEL]), the other channels of the
+    # EDF are never loaded. By default every channel except DROP_CHANNELS is kept.
+    # memmap_dir: the EDF samples are decoded into a memory-mapped file in this folder
+    # instead of RAM (only the resampled recording is kept in memory).
+    # With cache_dir the preprocessed recording is stored as float32 FIF, keyed by the
+    # EDF content and the preprocessing parameters: a changed EDF, band or rate
+    # gives a new key, so stale files are never read
+    name = os.path.splitext(os.path.basename(fname_edf))[0]
+    if cache_dir is not None:
+        params = dict(sfreq=sfreq, l_freq=l_freq, h_freq=h_freq)
+        if picks is None:
+            params["drop"] = DROP_CHANNELS
+        else:
+            params["picks"] = list(picks)
+        key = hashlib.sha1((file_hash(fname_edf) + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+        fname_cache = os.path.join(cache_dir, "{}_{}_raw.fif".format(name, key[:16]))
+        if os.path.exists(fname_cache):
+            # Not preloaded: the data is read from disk only when it is needed
+            with stage_timer("cache_read") as record:
+                raw = mne.io.read_raw_fif(fname_cache, preload=False)
+                record["epochs"] = _raw_epochs(raw)
+            return raw, raw.ch_names, raw.info["sfreq"]
+
+    preload = True
+    if memmap_dir is not None:
+        os.makedirs(memmap_dir, exist_ok=True)
+        preload = os.path.join(memmap_dir, "{}.dat".format(name))
+
+    try:
+        #Polysomnography data
+        #Selecting channels
+        with stage_timer("edf_read") as record:
+            if picks is not None:
+                raw = mne.io.read_raw_edf(fname_edf, include=list(picks), preload=preload)
+            else:
+                raw = mne.io.read_raw_edf(fname_edf, exclude=DROP_CHANNELS, preload=preload)
+            record["epochs"] = _raw_epochs(raw)
+        chan = raw.ch_names
+
+        with stage_timer("resample", epochs=_raw_epochs(raw)):
+            raw.resample(sfreq)
+    finally:
+        # The resampled recording is in memory, the scratch file of the EDF samples is not needed
+        if memmap_dir is not None and os.path.exists(preload):
+            with suppress(OSError):  # Windows keeps a mapped file until it is released
+                os.remove(preload)
     sf = raw.info["sfreq"]
-    raw.filter(0.3, 45)
+    with stage_timer("filter", epochs=_raw_epochs(raw)):
+        raw.filter(l_freq, h_freq)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that a crash never leaves a broken cache entry
+        fname_tmp = fname_cache.replace("_raw.fif", "_tmp_raw.fif")
+        with stage_timer("cache_write", epochs=_raw_epochs(raw)):
+            raw.save(fname_tmp, fmt='single', overwrite=True)
+        os.replace(fname_tmp, fname_cache)
 
     return raw, chan, sf
 
-def generate_random_annotations(fname_txt, folder_metrics_path, subject):
-    hypno = pd.read_csv(fname_txt).squeeze()
+# 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
+STAGE_CODES = {'W': 0, 'N1': 1, 'N2': 2, 'N3': 3, 'R': 4}
+# Annotations of sleepscoring.txt that are not sleep stages
+NOT_STAGES = ['Lights off', 'Lights on']
+
+@instrumented("parsing", epochs=lambda result: len(result[0]))
+def parse_sleepscoring(fname_txt, mapping=STAGE_CODES):
+    # Sleep stages (int8 codes of `mapping`) and their onsets (seconds from the recording start)
+    hypno = pd.read_csv(fname_txt, skipinitialspace=True)
+    # Annotations are in the second-to-last column, onsets in the 'Recording onset' column
+    codes, labels = pd.factorize(hypno.iloc[:, -2])
+    if (codes < 0).any():
+        raise ValueError(f"Empty annotations in {fname_txt}")
+    # Lookup table over the distinct labels only: no per-row Python code, -1 for not stages
+    lut = np.empty(len(labels), dtype=np.int8)
+    for i, label in enumerate(labels):
+        # Remove 'Sleep stage ' prefix if it exists in the values
+        label = str(label).replace('Sleep stage ', '').strip()
+        if label in NOT_STAGES:
+            lut[i] = -1
+        elif label in mapping:
+            lut[i] = mapping[label]
+        else:
+            raise ValueError(f"Unknown annotation '{label}' in {fname_txt}")
+    stages = lut[codes]
+    #Filter out not stages
+    mask = stages >= 0
+    onsets = hypno.iloc[:, 2].to_numpy(dtype=float)[mask]
+    return stages[mask], onsets
+
+def write_annotations(fname, stages):
+    # Annotation column of int codes, the file is rewritten only when its content changes
+    content = "Annotation\n" + "".join(line + "\n" for line in np.asarray(stages).astype(str))
+    if os.path.exists(fname) and os.path.getsize(fname) == len(content):
+        with open(fname, 'r', newline='', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    with open(fname, 'w', newline='', encoding='utf-8') as f:
+        f.write(content)
+    return True
+
+def prepare_data_for_hypnogram(fname_txt, folder_metrics_path=None, subject=None, return_onsets=False):
     # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
-    sleep_stage_mapping = {
-        'W': '0',
-        'N1': '1',
-        'N2': '2',
-        'N3': '3',
-        'R': '4'
-    }
+    # return_onsets: also the onsets of the stages, see align_hypnograms
+    hypno_filtered, onsets = parse_sleepscoring(fname_txt)
 
+    # Save the int codes to {subject}_annotations_doctor.csv
+    if folder_metrics_path is not None:
+        fname = os.path.join(folder_metrics_path, "{}_annotations_doctor.csv".format(subject))
+        write_annotations(fname, hypno_filtered)
 
-    # Extract the sleep stages (keys)
-    stages = list(sleep_stage_mapping.keys())
+    if return_onsets:
+        return hypno_filtered, onsets
+    return hypno_filtered
 
-    # Shuffle the stages to randomize the order
-    random.shuffle(stages)
+# Epoch of a recording without a stage of the other scoring
+UNSCORED = -2
 
-    # Create a new mapping with the shuffled stages
-    randomized_mapping = {stage: str(i) for i, stage in enumerate(stages)}
+def align_epochs(onsets, n_epochs, epoch_sec=30):
+    # Index of the YASA epoch (k covers [k * epoch_sec, (k + 1) * epoch_sec) from the EDF start)
+    # of every scored epoch, -1 when it is outside the n_epochs of YASA or already scored,
+    # and a report of the offsets
+    onsets = np.asarray(onsets, dtype=float)
+    # Nearest epoch, halves go to the later epoch
+    index = np.floor(onsets / epoch_sec + 0.5).astype(np.int64)
+    inside = (index >= 0) & (index < n_epochs)
+    # Two stages in the same epoch: the first one is kept
+    first = np.zeros(len(index), dtype=bool)
+    first[np.unique(index, return_index=True)[1]] = True
+    keep = inside & first
+    report = dict(n_doctor=len(onsets), n_yasa=int(n_epochs), n_aligned=int(keep.sum()),
+                  start_sec=float(onsets[0]) if len(onsets) else 0.0,
+                  max_shift_sec=float(np.abs(onsets - index * epoch_sec).max()) if len(onsets) else 0.0,
+                  doctor_outside=int((~inside).sum()), doctor_duplicates=int((inside & ~first).sum()),
+                  yasa_unscored=int(n_epochs - keep.sum()))
+    return np.where(keep, index, -1), report
 
-    # Print the randomized mapping
-    print(randomized_mapping)
+def align_hypnograms(doctor_hypno_scoring, onsets, hypno_pred, epoch_sec=30):
+    # Doctor's and YASA int8 stages of the same epochs, only the epochs scored by both, and the report
+    # of align_epochs. YASA stages for every doctor's epoch (UNSCORED if none) are
+    # np.where(index >= 0, hypno_pred[index], UNSCORED) with index from align_epochs.
+    index, report = align_epochs(onsets, len(hypno_pred), epoch_sec)
+    keep = index >= 0
+    doctor = np.asarray(doctor_hypno_scoring, dtype=np.int8)[keep]
+    pred = np.asarray(hypno_pred, dtype=np.int8)[index[keep]]
+    return doctor, pred, report
 
+def misaligned(report):
+    # The scoring does not start at an epoch boundary of the recording or does not fit the YASA epochs
+    return report["max_shift_sec"] > 0 or report["doctor_outside"] > 0 or report["doctor_duplicates"] > 0
 
-    # Modify the file with staging info
-    # Get the second-to-last column name with Annotations
-    second_last_col = hypno.columns[-2]
-    # Remove 'Sleep stage ' prefix if it exists in the values
-    hypno_clean = hypno[second_last_col].astype(str).str.replace('Sleep stage ', '', regex=False)
-    # Remove whitespace
-    hypno_clean = hypno_clean.str.strip()
-    # Map the values using the dictionary
-    hypno_modified = hypno_clean.map(lambda x: randomized_mapping.get(x, x))
-    #Filter out not stages
-    mask = ~hypno_modified.isin(['Lights off', 'Lights on'])
-    hypno_filtered = hypno_modified[mask]
-    #hypno_filtered.name = 'Annotation'
-    # Save the modified DataFrame to a new CSV file
-    hypno_filtered.name = 'Annotation'
-    fname = folder_metrics_path +  "/{}_annotations_doctor.csv".format(subject)
-    hypno_filtered.to_csv(fname, index=False)
+# Multitaper spectrogram of yasa.plot_spectrogram (30-sec windows without overlap), computed once
+# per subject and stored up to SPECTROGRAM_FMAX Hz for the figures and band-power analytics
+SPECTROGRAM_WIN_SEC = 30
+SPECTROGRAM_FMAX = 35
 
+def compute_spectrogram(data, sf, win_sec=SPECTROGRAM_WIN_SEC, fmax=SPECTROGRAM_FMAX):
+    # data: 1-D EEG in uV. Returns frequencies, window centers (sec) and (time, freq) float32 power in uV^2 / Hz
+    from lspopt import spectrogram_lspopt
+    nperseg = int(win_sec * sf)
+    freqs, times, Sxx = spectrogram_lspopt(data, sf, nperseg=nperseg, noverlap=0)
+    good_freqs = freqs <= fmax
+    return freqs[good_freqs], times, np.ascontiguousarray(Sxx[good_freqs].T, dtype=np.float32)
 
-    return hypno_filtered
+def save_spectrogram(fname, freqs, times, power, metadata):
+    np.savez(fname, freqs=freqs, times=times, power=np.asarray(power, dtype=np.float32),
+             metadata=json.dumps(metadata))
 
-def prepare_data_for_hypnogram(fname_txt, folder_metrics_path, subject):
-    hypno = pd.read_csv(fname_txt).squeeze()
+def load_spectrogram(fname):
+    # (frequencies, times, (time, freq) power, metadata) saved by save_spectrogram
+    with np.load(fname) as npz:
+        return npz["freqs"], npz["times"], npz["power"], json.loads(str(npz["metadata"]))
 
-    # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
-    sleep_stage_mapping = {
-        'W': '0',
-        'N1': '1',
-        'N2': '2',
-        'N3': '3',
-        'R': '4'
-    }
+def spectrogram_store(raw, cache_path, eeg_name=EEG_CHANNEL, source=None):
+    # Computes the spectrogram of eeg_name into cache_path unless it is there with the same
+    # channel, parameters and `source` (e.g. stage_signature of the EDF). Only this channel is read.
+    # The run log records reading the store as "spectrogram_cache" and computing it as "spectrogram".
+    metadata = dict(eeg=eeg_name, sf=raw.info["sfreq"], n_times=int(raw.n_times),
+                    win_sec=SPECTROGRAM_WIN_SEC, fmax=SPECTROGRAM_FMAX, source=source)
+    if os.path.exists(cache_path):
+        with stage_timer("spectrogram_cache") as record:
+            freqs, times, power, cached_metadata = load_spectrogram(cache_path)
+            record["epochs"] = len(times)
+        if cached_metadata == metadata:
+            return freqs, times, power
 
-    # Modify the file with staging info
-    # Get the second-to-last column name with Annotations
-    second_last_col = hypno.columns[-2]
-    # Remove 'Sleep stage ' prefix if it exists in the values
-    hypno_clean = hypno[second_last_col].astype(str).str.replace('Sleep stage ', '', regex=False)
-    # Remove whitespace
-    hypno_clean = hypno_clean.str.strip()
-    # Map the values using the dictionary
-    hypno_modified = hypno_clean.map(lambda x: sleep_stage_mapping.get(x, x))
-    #Filter out not stages
-    mask = ~hypno_modified.isin(['Lights off', 'Lights on'])
-    hypno_filtered = hypno_modified[mask]
-    #hypno_filtered.name = 'Annotation'
-    # Save the modified DataFrame to a new CSV file
-    hypno_filtered.name = 'Annotation'
-    fname = folder_metrics_path +  "/{}_annotations_doctor.csv".format(subject)
-    hypno_filtered.to_csv(fname, index=False)
+    with stage_timer("spectrogram") as record:
+        data = raw.get_data(picks=[eeg_name], units="uV")[0]
+        freqs, times, power = compute_spectrogram(data, raw.info["sfreq"])
+        save_spectrogram(cache_path, freqs, times, power, metadata)
+        record["epochs"] = len(times)
+    return freqs, times, power
 
-    return hypno_filtered
+# Band power of every 30-sec epoch: the bands of yasa.bandpower up to beta
+BANDPOWER_BANDS = [(0.5, 4, "delta"), (4, 8, "theta"), (8, 12, "alpha"), (12, 16, "sigma"), (16, 30, "beta")]
+BANDPOWER_EPOCH_SEC = 30
+# Welch segments (hamming, median average), as in yasa.bandpower
+BANDPOWER_WIN_SEC = 4
 
-def plot_hypnogram(fname_pics, hypno_filtered):
-    ax = yasa.plot_hypnogram(hypno_filtered)
-    fig = ax.get_figure()
-    fig.set_size_inches(35, 6)
-    fig.savefig(fname_pics , dpi=300, bbox_inches='tight')
-    plt.close(fig)
+def epoch_psd(data, sf, epoch_sec=BANDPOWER_EPOCH_SEC, win_sec=BANDPOWER_WIN_SEC):
+    # Welch PSD of every 30-sec epoch of every channel of data (channels, samples; uV) in one call:
+    # the epochs are a (channels, epochs, samples) view. Returns frequencies and (channels, epochs, freq)
+    # power in uV^2 / Hz, the samples after the last full epoch are left out.
+    data = np.atleast_2d(data)
+    n = int(epoch_sec * sf)
+    n_epochs = data.shape[1] // n
+    epochs = data[:, :n_epochs * n].reshape(len(data), n_epochs, n)
+    return sp_sig.welch(epochs, sf, window="hamming", nperseg=int(win_sec * sf), average="median", axis=-1)
 
-def plot_spectrogram(fname_pics, chan, sf, hypno_filtered, raw):
-    # Upsample our hypnogram from 0.333 Hz to 100 Hz
-    hypno_up = yasa.hypno_upsample_to_data(hypno_filtered, sf_hypno=1 / 30, data=raw)
-    data = raw.get_data(units="uV")
-    ax = yasa.plot_spectrogram(data[chan.index("EEG C4-M1")], sf, hypno_up)
-    fig = ax.get_figure()
-    fig.set_size_inches(35, 6)
-    fig.savefig(fname_pics, dpi=300, bbox_inches='tight')
-    plt.close(fig)
+def band_power(freqs, psd, bands=BANDPOWER_BANDS):
+    # Absolute (uV^2) and relative power (to the bands range) of the bands along the last axis of psd,
+    # (..., bands) each, integrated as in yasa.bandpower
+    absolute = yasa.bandpower_from_psd_ndarray(psd, freqs, bands=bands, relative=False)
+    relative = yasa.bandpower_from_psd_ndarray(psd, freqs, bands=bands, relative=True)
+    return np.moveaxis(absolute, 0, -1), np.moveaxis(relative, 0, -1)
+
+@instrumented("bandpower", epochs=lambda result: result[0].shape[1])
+def epoch_bandpower(raw, channels=(EEG_CHANNEL,), method="welch", fname_spectrogram=None, source=None):
+    # (channels, epochs, bands) absolute and relative band power of the 30-sec epochs of the recording.
+    # method="welch": epoch_psd of all the channels at once; "multitaper": the spectrogram of
+    # spectrogram_store (30-sec windows = epochs), taken from fname_spectrogram for EEG_CHANNEL when it
+    # was stored with the same `source` (the stage step uses stage_signature of the EDF).
+    sf = raw.info["sfreq"]
+    if method == "welch":
+        freqs, psd = epoch_psd(raw.get_data(picks=list(channels), units="uV"), sf)
+    elif method == "multitaper":
+        spectra = []
+        for channel in channels:
+            if channel == EEG_CHANNEL and fname_spectrogram is not None:
+                freqs, _, power = spectrogram_store(raw, fname_spectrogram, source=source)
+            else:
+                freqs, _, power = compute_spectrogram(raw.get_data(picks=[channel], units="uV")[0], sf)
+            spectra.append(power)
+        psd = np.stack(spectra)
+    else:
+        raise ValueError(f"Unknown band power method {method}")
+    return band_power(freqs, psd)
 
-def yasa_staging(fname_pics, raw):
-    sls = yasa.SleepStaging(raw, eeg_name="EEG C4-M1")
-    hypno_pred = sls.predict()  # Predict the sleep stages
-    hypno_pred = yasa.hypno_str_to_int(hypno_pred)  # Convert "W" to 0, "N1" to 1, etc
-    ax = yasa.plot_hypnogram(hypno_pred)  # Plot
-    fig = ax.get_figure()
+# Figure outputs: fast preview, the default 300 dpi PNG and a print-quality PDF
+RENDER_PRESETS = {
+    "preview": dict(dpi=100, format="png"),
+    "default": dict(dpi=300, format="png"),
+    "print": dict(dpi=300, format="pdf"),
+}
+
+def figure_path(fname_pics, preset="default"):
+    # File name with the extension of the preset format
+    return os.path.splitext(fname_pics)[0] + "." + RENDER_PRESETS[preset]["format"]
+
+def _save_figure(fig, fname_pics, preset="default"):
+    import matplotlib.pyplot as plt
     fig.set_size_inches(35, 6)
-    fig.savefig(fname_pics, dpi=300, bbox_inches='tight')
+    fig.savefig(figure_path(fname_pics, preset), dpi=RENDER_PRESETS[preset]["dpi"],
+                format=RENDER_PRESETS[preset]["format"], bbox_inches='tight')
     plt.close(fig)
 
+def plot_hypnogram(fname_pics, hypno_filtered, preset="default"):
+    ax = yasa.plot_hypnogram(hypno_filtered)
+    _save_figure(ax.get_figure(), fname_pics, preset)
+
+def plot_spectrogram(fname_pics, hypno_filtered, fname_spectrogram, preset="default",
+                     fmin=0.5, fmax=25, trimperc=2.5, cmap="RdBu_r"):
+    # Same figure as yasa.plot_spectrogram, drawn from the store of spectrogram_store()
+    # instead of recomputing the multitaper spectrogram from the EEG
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import Normalize
+    freqs, times, power, _ = load_spectrogram(fname_spectrogram)
+    good_freqs = np.logical_and(freqs >= fmin, freqs <= fmax)
+    Sxx = 10 * np.log10(power[:, good_freqs].T)  # uV^2 / Hz --> dB / Hz, (freq, time)
+    t = times / 3600  # Convert t to hours
+    vmin, vmax = np.percentile(Sxx, [0 + trimperc, 100 - trimperc])
+
+    old_fontsize = plt.rcParams["font.size"]
+    plt.rcParams.update({"font.size": 18})
+    fig, (ax0, ax1) = plt.subplots(nrows=2, figsize=(12, 6),
+                                   gridspec_kw={"height_ratios": [1, 2], "hspace": 0.1})
+    ax1.pcolormesh(t, freqs[good_freqs], Sxx, norm=Normalize(vmin=vmin, vmax=vmax), cmap=cmap,
+                   antialiased=True, shading="auto")
+    ax1.set_xlim(0, t.max())
+    ax1.set_ylabel("Frequency [Hz]")
+    ax1.set_xlabel("Time [hrs]")
+    yasa.plot_hypnogram(np.asarray(hypno_filtered), sf_hypno=1 / 30, ax=ax0, lw=1.5, fill_color=None)
+    ax0.xaxis.set_visible(False)
+    plt.rcParams.update({"font.size": old_fontsize})
+    _save_figure(fig, fname_pics, preset)
+
+def render_job(plot_func, fname_pics, *args):
+    # Figure to draw later by FigureRenderer: plot_func(fname_pics, *args, preset=...),
+    # with the subject being processed for the run log
+    return plot_func.__name__, fname_pics, args, _current_subject
+
+def _render(job, preset):
+    # Runs in a FigureRenderer worker
+    plot_func_name, fname_pics, args, subject = job
+    # args[0] is the hypnogram of both plot functions
+    with stage_timer("render_" + plot_func_name, subject, epochs=len(args[0])):
+        globals()[plot_func_name](fname_pics, *args, preset=preset)
+    return figure_path(fname_pics, preset)
+
+def _init_render_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+class FigureRenderer:
+    # Background pool of worker processes drawing the figures with the Agg backend,
+    # so that the pipeline goes on with the next subject. With jobs=0 figures are drawn
+    # immediately in the calling process.
+    def __init__(self, jobs=1, preset="default"):
+        self.preset = preset
+        self.futures = []
+        self.executor = None
+        if jobs > 0:
+            self.executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_render_worker)
+
+    def submit(self, job):
+        if self.executor is None:
+            _render(job, self.preset)
+        else:
+            self.futures.append(self.executor.submit(_render, job, self.preset))
+
+    def submit_all(self, jobs):
+        for job in jobs:
+            self.submit(job)
+
+    def wait(self):
+        # Waits for the pending figures, a failed figure is reported and skipped
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error rendering figure: {e}")
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+def add_render_arguments(parser):
+    parser.add_argument("--render-jobs", type=int, default=2,
+                        help="number of background processes drawing the figures (0 - draw immediately)")
+    parser.add_argument("--preset", choices=sorted(RENDER_PRESETS), default="default",
+                        help="figure quality: preview PNG, default 300 dpi PNG or print PDF")
+    return parser
+
+# Features of yasa.SleepStaging: 30-sec epochs of the 0.4-30 Hz signal at 100 Hz
+STAGING_EPOCH_SEC = 30
+STAGING_SFREQ = 100
+STAGING_BANDS = [(0.4, 1, "sdelta"), (1, 4, "fdelta"), (4, 8, "theta"),
+                 (8, 12, "alpha"), (12, 16, "sigma"), (16, 30, "beta")]
+# EEG derivations of the recordings, EOG and EMG that ensemble staging (yasa_predict_ensemble) can use
+STAGING_EEG_DERIVATIONS = ["EEG C4-M1", "EEG C3-M2", "EEG F4-M1", "EEG O2-M1"]
+# Default ensemble: two central derivations stay within ~1.5x the single-channel staging, all four cost
+# ~2.5-3x and four with EOG and EMG ~4-5x (features are computed per channel)
+STAGING_EEG_CHANNELS = STAGING_EEG_DERIVATIONS[:2]
+STAGING_EOG_CHANNEL = "EOG E1-M2"
+STAGING_EMG_CHANNEL = "EMG chin"
+# Epochs whose features are computed together by staging_channel_features
+STAGING_BLOCK_EPOCHS = 256
+
+def _epoch_features(epochs, sf, ch_type):
+    # Features of every row of epochs (rows, samples) of the 0.4-30 Hz signal, as in yasa.SleepStaging.fit
+    freq_broad = (0.4, 30)
+    hmob, hcomp = ant.hjorth_params(epochs, axis=1)
+    feat = {
+        "std": np.std(epochs, ddof=1, axis=1),
+        "iqr": sp_stats.iqr(epochs, rng=(25, 75), axis=1),
+        "skew": sp_stats.skew(epochs, axis=1),
+        "kurt": sp_stats.kurtosis(epochs, axis=1),
+        "nzc": ant.num_zerocross(epochs, axis=1),
+        "hmob": hmob,
+        "hcomp": hcomp,
+    }
+    # Spectral power (EEG + EOG), power ratios (EEG) and total power
+    freqs, psd = sp_sig.welch(epochs, sf, window="hamming", nperseg=int(5 * sf), average="median")
+    if ch_type != "emg":
+        bp = yasa.bandpower_from_psd_ndarray(psd, freqs, bands=STAGING_BANDS)
+        for j, (_, _, b) in enumerate(STAGING_BANDS):
+            feat[b] = bp[j]
+    if ch_type == "eeg":
+        delta = feat["sdelta"] + feat["fdelta"]
+        feat["dt"] = delta / feat["theta"]
+        feat["ds"] = delta / feat["sigma"]
+        feat["db"] = delta / feat["beta"]
+        feat["at"] = feat["alpha"] / feat["theta"]
+    idx_broad = np.logical_and(freqs >= freq_broad[0], freqs <= freq_broad[1])
+    feat["abspow"] = sp_integrate.trapezoid(psd[:, idx_broad], dx=freqs[1] - freqs[0])
+    # Entropy and fractal dimension
+    feat["perm"] = np.apply_along_axis(ant.perm_entropy, axis=1, arr=epochs, normalize=True)
+    feat["higuchi"] = np.apply_along_axis(ant.higuchi_fd, axis=1, arr=epochs)
+    feat["petrosian"] = ant.petrosian_fd(epochs, axis=1)
+    return feat
+
+def staging_channel_features(data, sf=STAGING_SFREQ, ch_types=("eeg",)):
+    # Features of each 30-sec epoch of every channel of data (channels, samples; uV), the same as in
+    # yasa.SleepStaging.fit before smoothing and normalization, in one pass per channel type: the channels
+    # are filtered together and the epochs of all the channels of a type are stacked into one
+    # (channels * epochs, samples) array. Returns the epoch times and one DataFrame per channel.
+    data = mne.filter.filter_data(np.atleast_2d(data), sf, l_freq=0.4, h_freq=30, verbose=False)
+    n = int(STAGING_EPOCH_SEC * sf)
+    n_epochs = data.shape[1] // n
+    epochs = data[:, :n_epochs * n].reshape(len(data), n_epochs, n)
+    ch_types = np.asarray(ch_types)
+    features = [None] * len(data)
+    for ch_type in np.unique(ch_types):
+        channels = np.flatnonzero(ch_types == ch_type)
+        stacked = epochs[channels].reshape(-1, n)
+        # Blocks of STAGING_BLOCK_EPOCHS rows keep the temporary arrays small: the features of each epoch
+        # only depend on its own samples, and big temporaries are slower to allocate than to compute
+        blocks = [_epoch_features(stacked[start:start + STAGING_BLOCK_EPOCHS], sf, ch_type)
+                  for start in range(0, len(stacked), STAGING_BLOCK_EPOCHS)]
+        feat = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+        for i, ch in enumerate(channels):
+            rows = slice(i * n_epochs, (i + 1) * n_epochs)
+            features[ch] = pd.DataFrame({name: values[rows] for name, values in feat.items()}).add_prefix(
+                ch_type + "_")
+    return np.arange(n_epochs) * float(STAGING_EPOCH_SEC), features
+
+def finalize_staging_features(features, times):
+    # Smoothing and normalization over the whole night + temporal features,
+    # the same as in yasa.SleepStaging.fit
+    from sklearn.preprocessing import robust_scale
+    features = features.reset_index(drop=True)
+    features.index.name = "epoch"
+    # Centered rolling average (15 epochs = 7 min 30), triangular window
+    rollc = features.rolling(window=15, center=True, min_periods=1, win_type="triang").mean()
+    rollc[rollc.columns] = robust_scale(rollc, quantile_range=(5, 95))
+    rollc = rollc.add_suffix("_c7min_norm")
+    # Past 2 minutes
+    rollp = features.rolling(window=4, min_periods=1).mean()
+    rollp[rollp.columns] = robust_scale(rollp, quantile_range=(5, 95))
+    rollp = rollp.add_suffix("_p2min_norm")
+    features = features.join(rollc).join(rollp)
+    features["time_hour"] = times / 3600
+    features["time_norm"] = times / times[-1]
+    cols_float = features.select_dtypes(np.float64).columns.tolist()
+    features[cols_float] = features[cols_float].astype(np.float32)
+    return features.sort_index(axis=1)
+
+def staging_model_path(ch_types=("eeg",)):
+    # Latest pre-trained LightGBM classifier of YASA for these channel types
+    clf_dir = os.path.join(os.path.dirname(yasa.__file__), "classifiers")
+    name = "clf_" + "+".join(ch_types)
+    all_matching_files = sorted(glob.glob(os.path.join(clf_dir, name + "_lgb_*.joblib")))
+    if not all_matching_files:
+        raise FileNotFoundError(f"No pre-trained classifier {name} in {clf_dir}")
+    return all_matching_files[-1]
+
+def staging_model(ch_types=("eeg",)):
+    return joblib.load(staging_model_path(ch_types))
+
+def save_staging(fname, hypno_pred, proba, metadata):
+    # One compact .npz: int8 hypnogram, float16 probabilities, metadata as JSON
+    np.savez(fname, hypno=np.asarray(hypno_pred, dtype=np.int8),
+             proba=np.asarray(proba, dtype=np.float16), classes=np.asarray(proba.columns, dtype=str),
+             metadata=json.dumps(metadata))
+
+def load_staging(fname):
+    # (hypnogram, probabilities DataFrame, metadata) saved by save_staging
+    with np.load(fname) as npz:
+        proba = pd.DataFrame(npz["proba"].astype(np.float32), columns=npz["classes"])
+        proba.index.name = "epoch"
+        return npz["hypno"], proba, json.loads(str(npz["metadata"]))
+
+def _cached_staging(cache_path, metadata):
+    # Hypnogram and probabilities stored in cache_path with the same metadata, otherwise None.
+    # Recorded in the run log as "staging_cache", apart from the staging itself.
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    with stage_timer("staging_cache") as record:
+        hypno_pred, proba, cached_metadata = load_staging(cache_path)
+        record["epochs"] = len(hypno_pred)
+    return (hypno_pred, proba) if cached_metadata == metadata else None
+
+def _staging_predict(raw, eeg_names, eog_name=None, emg_name=None):
+    # Hypnogram (int8) and probabilities of the YASA classifier of eeg[+eog][+emg] (staging_model_path),
+    # averaged over the EEG derivations: the features of all the channels are computed in one pass
+    # (staging_channel_features) and smoothed together, the EOG and EMG features are shared by every derivation
+    sf = raw.info["sfreq"]
+    if sf != STAGING_SFREQ:
+        raise ValueError(f"Staging needs {STAGING_SFREQ} Hz data, got {sf} Hz")
+    ch_types = ["eeg"] + (["eog"] if eog_name else []) + (["emg"] if emg_name else [])
+    names = list(eeg_names) + [name for name in (eog_name, emg_name) if name]
+    types = ["eeg"] * len(eeg_names) + ch_types[1:]
+    times, features = staging_channel_features(raw.get_data(picks=names, units="uV"), sf, types)
+    # The EEG columns of derivation i are prefixed with "i|" so that all the columns are smoothed
+    # and normalized at once (column by column, as for a single derivation)
+    features = pd.concat([feat.add_prefix(f"{i}|") for i, feat in enumerate(features[:len(eeg_names)])]
+                         + features[len(eeg_names):], axis=1)
+    features = finalize_staging_features(features, times)
+
+    clf = staging_model(ch_types)
+    proba = np.zeros((len(features), len(clf.classes_)))
+    for i in range(len(eeg_names)):
+        prefix = f"{i}|"
+        X = features.rename(columns=lambda c: c[len(prefix):] if c.startswith(prefix) else c)[clf.feature_name_]
+        proba += clf.predict_proba(X)
+    proba = pd.DataFrame(proba / len(eeg_names), columns=clf.classes_)
+    proba.index.name = "epoch"
+    # "W" -> 0, "N1" -> 1, etc (STAGE_CODES, the classes of the YASA classifiers)
+    codes = np.array([STAGE_CODES[stage] for stage in clf.classes_], dtype=np.int8)
+    hypno_pred = codes[proba.to_numpy().argmax(axis=1)]
+    return hypno_pred, proba
+
+def yasa_predict(raw, eeg_name=EEG_CHANNEL, cache_path=None, source=None):
+    # YASA hypnogram (int8) and per-epoch probabilities. With cache_path the result is stored
+    # once and reused while the yasa version, model, channel, epoch count and `source`
+    # (anything identifying the recording, e.g. stage_signature of the EDF) are unchanged.
+    metadata = dict(yasa=yasa.__version__, model=os.path.basename(staging_model_path(("eeg",))),
+                    eeg=eeg_name, n_epochs=int(raw.n_times // (STAGING_EPOCH_SEC * raw.info["sfreq"])),
+                    source=source)
+    cached = _cached_staging(cache_path, metadata)
+    if cached is not None:
+        return cached
+
+    with stage_timer("staging") as record:
+        # Same features and classifier as yasa.SleepStaging, whose predict() return type depends on the
+        # yasa version
+        hypno_pred, proba = _staging_predict(raw, [eeg_name])
+        record["epochs"] = len(hypno_pred)
+
+        if cache_path is not None:
+            save_staging(cache_path, hypno_pred, proba, metadata)
+    return hypno_pred, proba
+
+def yasa_predict_ensemble(raw, eeg_names=STAGING_EEG_CHANNELS, eog_name=None, emg_name=None, cache_path=None,
+                          source=None):
+    # Soft voting of YASA over several EEG derivations, optionally with EOG and EMG (_staging_predict):
+    # the YASA model of eeg[+eog][+emg] predicts each derivation and the probabilities are averaged.
+    # Returns the hypnogram (int8) and the averaged probabilities, stored in cache_path like yasa_predict.
+    ch_types = ["eeg"] + (["eog"] if eog_name else []) + (["emg"] if emg_name else [])
+    model_path = staging_model_path(ch_types)
+    metadata = dict(yasa=yasa.__version__, model=os.path.basename(model_path), eeg=list(eeg_names), eog=eog_name,
+                    emg=emg_name, voting="soft", n_epochs=_raw_epochs(raw), source=source)
+    cached = _cached_staging(cache_path, metadata)
+    if cached is not None:
+        return cached
+
+    with stage_timer("staging_ensemble") as record:
+        hypno_pred, proba = _staging_predict(raw, eeg_names, eog_name, emg_name)
+        record["epochs"] = len(hypno_pred)
+
+        if cache_path is not None:
+            save_staging(cache_path, hypno_pred, proba, metadata)
+    return hypno_pred, proba
+
+def staging_picks(eeg_names=(EEG_CHANNEL,), eog_name=None, emg_name=None):
+    # Channels read by yasa_staging
+    return list(eeg_names) + [name for name in (eog_name, emg_name) if name]
+
+def add_staging_arguments(parser):
+    parser.add_argument("--eeg", nargs="+", default=[EEG_CHANNEL],
+                        help="EEG derivations of the staging, several are combined by soft voting "
+                             "(e.g. " + " ".join(f"'{name}'" for name in STAGING_EEG_CHANNELS) + ", up to "
+                             + " ".join(f"'{name}'" for name in STAGING_EEG_DERIVATIONS) + " at a higher cost)")
+    parser.add_argument("--eog", help=f"EOG channel added to the staging (e.g. '{STAGING_EOG_CHANNEL}')")
+    parser.add_argument("--emg", help=f"EMG channel added to the staging (e.g. '{STAGING_EMG_CHANNEL}')")
+    return parser
+
+def staging_channels(args):
+    # Keyword arguments of yasa_staging / staging_picks from add_staging_arguments
+    return dict(eeg_names=list(args.eeg), eog_name=args.eog, emg_name=args.emg)
+
+def yasa_staging(fname_pics, raw, cache_path=None, source=None, eeg_names=(EEG_CHANNEL,), eog_name=None,
+                 emg_name=None):
+    # fname_pics=None: no figure, e.g. when it is drawn by FigureRenderer
+    # One EEG derivation: yasa.SleepStaging; several or with EOG/EMG: the soft-voting ensemble
+    if len(eeg_names) == 1 and not eog_name and not emg_name:
+        hypno_pred, _ = yasa_predict(raw, eeg_names[0], cache_path=cache_path, source=source)
+    else:
+        hypno_pred, _ = yasa_predict_ensemble(raw, eeg_names, eog_name, emg_name, cache_path=cache_path,
+                                              source=source)
+    if fname_pics is not None:
+        plot_hypnogram(fname_pics, hypno_pred)  # Plot
+
     return hypno_pred
 
-def average_recall(results_dict):
-    #Recall = Sensitivity: Recall = True Positives / (True Positives + False Negatives)
-    recalls = []
-    for key, metrics in results_dict.items():
-        # Ignore keys not attributed to classes 'accuracy', 'macro avg' и т.д.
-        if key.isdigit():
-            recalls.append(metrics['recall'])
-    if recalls:
-        average_recall = sum(recalls) / len(recalls)
-        print('кол-во классов', len(recalls))
-        return np.round(average_recall, 2)
+# 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
+N_STAGES = 5
+
+def stage_confusion(doctor_hypno_scoring, hypno_pred, n_classes=N_STAGES):
+    # Confusion matrix in one np.bincount: rows - doctor, columns - yasa
+    y_true = np.asarray(doctor_hypno_scoring, dtype=np.int64)
+    y_pred = np.asarray(hypno_pred, dtype=np.int64)
+    codes = y_true * n_classes + y_pred
+    return np.bincount(codes, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+def _ratio(num, den):
+    # num / den with 0 where den == 0 (same as zero_division=0 in sklearn)
+    num, den = np.broadcast_arrays(np.asarray(num, dtype=float), np.asarray(den, dtype=float))
+    return np.divide(num, den, out=np.zeros(num.shape), where=den > 0)
+
+def metrics_from_confusion(cm):
+    # All the metrics of one or many confusion matrices of shape (..., n, n), rows - doctor,
+    # columns - yasa. Per-class values are arrays of shape (..., n), the rest have shape (...).
+    # Macro averages are taken over the classes present in either scoring, like sklearn does.
+    cm = np.asarray(cm)
+    total = cm.sum(axis=(-2, -1))
+    TP = np.diagonal(cm, axis1=-2, axis2=-1)
+    support = cm.sum(axis=-1)
+    predicted = cm.sum(axis=-2)
+    FN = support - TP
+    FP = predicted - TP
+    TN = total[..., None] - TP - FP - FN
+    per_class = {
+        "TP": TP, "FP": FP, "FN": FN, "TN": TN,
+        # Recall = Sensitivity = TP / (TP + FN)
+        "recall": _ratio(TP, TP + FN),
+        # Precision = Positive Predictive Value (PPV) = TP / (TP + FP)
+        "PPV": _ratio(TP, TP + FP),
+        "specificity": _ratio(TN, TN + FP),
+        # FPR = FP / (FP + TN)
+        "FPR": _ratio(FP, FP + TN),
+        "F1": _ratio(2 * TP, 2 * TP + FP + FN),
+    }
+    present = (support + predicted) > 0
+    n_present = present.sum(axis=-1)
+    macro = {name: _ratio((per_class[name] * present).sum(axis=-1), n_present)
+             for name in ["recall", "PPV", "specificity", "FPR", "F1"]}
+    # Micro: counts summed over the classes
+    micro = {name: per_class[name].sum(axis=-1) for name in ["TP", "FP", "FN", "TN"]}
+    micro["recall"] = _ratio(micro["TP"], micro["TP"] + micro["FN"])
+    micro["PPV"] = _ratio(micro["TP"], micro["TP"] + micro["FP"])
+    micro["specificity"] = _ratio(micro["TN"], micro["TN"] + micro["FP"])
+    micro["FPR"] = _ratio(micro["FP"], micro["FP"] + micro["TN"])
+    micro["F1"] = _ratio(2 * micro["TP"], 2 * micro["TP"] + micro["FP"] + micro["FN"])
+    accuracy = _ratio(TP.sum(axis=-1), total)
+    # Cohen's kappa
+    expected = _ratio((support * predicted).sum(axis=-1), total.astype(float) ** 2)
+    kappa = _ratio(accuracy - expected, 1 - expected)
+
+    result = {"confusion": cm, "support": support, "present": present}
+    result.update(per_class)
+    result.update({"macro": macro, "micro": micro, "accuracy": accuracy, "kappa": kappa})
+    return result
+
+def confusion_metrics(doctor_hypno_scoring, hypno_pred, n_classes=N_STAGES):
+    # Confusion matrix built once, every metric derived from it
+    return metrics_from_confusion(stage_confusion(doctor_hypno_scoring, hypno_pred, n_classes))
+
+@instrumented("confusion", epochs=lambda cms: int(cms.sum()))
+def cohort_confusion(doctor_hypno_list, hypno_pred_list, n_classes=N_STAGES):
+    # (subjects, n, n) confusion tensor of the whole cohort in one np.bincount
+    lengths = [len(doctor) for doctor in doctor_hypno_list]
+    for subject_idx, (length, pred) in enumerate(zip(lengths, hypno_pred_list)):
+        if len(pred) != length:
+            raise ValueError(f"Subject #{subject_idx}: {length} doctor's epochs, {len(pred)} yasa epochs")
+    n_subjects = len(lengths)
+    if n_subjects == 0:
+        return np.zeros((0, n_classes, n_classes), dtype=np.int64)
+    y_true = np.concatenate([np.asarray(doctor, dtype=np.int64) for doctor in doctor_hypno_list])
+    y_pred = np.concatenate([np.asarray(pred, dtype=np.int64) for pred in hypno_pred_list])
+    subject_idx = np.repeat(np.arange(n_subjects), lengths)
+    codes = (subject_idx * n_classes + y_true) * n_classes + y_pred
+    return np.bincount(codes, minlength=n_subjects * n_classes * n_classes).reshape(n_subjects, n_classes, n_classes)
+
+# Random baseline: chance level of the metrics when the doctor's stages carry no information about
+# the yasa ones, from relabeled stages (permutations of the mapping)
+# and from shuffled epochs. Higher is better for every metric except FPR.
+BASELINE_METRICS = ["recall", "PPV", "FPR", "F1", "accuracy", "kappa"]
+
+def _baseline_values(metrics):
+    values = {name: metrics["macro"][name] for name in ["recall", "PPV", "FPR", "F1"]}
+    values.update(accuracy=metrics["accuracy"], kappa=metrics["kappa"])
+    return values
+
+def stage_permutations(n_classes=N_STAGES, n_relabelings=None, seed=None):
+    # All n! mappings of the stages (120 for 5 stages) or n_relabelings random ones drawn with `seed`.
+    # Row p maps stage i to perms[p, i].
+    if n_relabelings is None:
+        return np.array(list(permutations(range(n_classes))))
+    rng = np.random.default_rng(seed)
+    return rng.permuted(np.tile(np.arange(n_classes), (n_relabelings, 1)), axis=1)
+
+def relabel_confusion(cm, perms):
+    # Confusion matrices (..., P, n, n) after relabeling the doctor's stages with every row of perms,
+    # obtained by permuting the rows of cm instead of relabeling the epochs
+    inverse = np.argsort(perms, axis=1)
+    return np.take(np.asarray(cm), inverse, axis=-2)
+
+def shuffle_confusion(doctor_hypno_scoring, hypno_pred, n_shuffles, seed=None, n_classes=N_STAGES):
+    # (n_shuffles, n, n) confusion matrices of the doctor's epochs shuffled in time against hypno_pred,
+    # all built with one np.bincount
+    doctor = np.asarray(doctor_hypno_scoring, dtype=np.int64)
+    pred = np.asarray(hypno_pred, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permuted(np.tile(doctor, (n_shuffles, 1)), axis=1)
+    codes = (np.arange(n_shuffles)[:, None] * n_classes + shuffled) * n_classes + pred
+    return np.bincount(codes.ravel(), minlength=n_shuffles * n_classes * n_classes).reshape(
+        n_shuffles, n_classes, n_classes)
+
+def _p_value(null, observed, name, exhaustive):
+    # One-sided: share of the null at least as good as the observed value. A Monte Carlo null
+    # gets the usual +1 correction, the full set of permutations already contains the identity.
+    better = null <= observed[..., None] if name == "FPR" else null >= observed[..., None]
+    count = better.sum(axis=-1)
+    if exhaustive:
+        return count / null.shape[-1]
+    return (count + 1) / (null.shape[-1] + 1)
+
+def random_baseline(cms, n_shuffle_cms=None, n_relabelings=None, seed=None):
+    # Chance distributions and p-values of BASELINE_METRICS for one (n, n) or many (S, n, n)
+    # confusion matrices. Relabeling: all stage permutations or n_relabelings seeded ones.
+    # n_shuffle_cms: optional (..., N, n, n) confusion matrices of shuffled epochs (shuffle_confusion).
+    # Returns {metric: dict(observed, relabel_mean, relabel_p, [shuffle_mean, shuffle_p])},
+    # plus the null distributions under "relabel_null" / "shuffle_null" (..., P or N).
+    cms = np.asarray(cms)
+    perms = stage_permutations(cms.shape[-1], n_relabelings, seed)
+    observed = _baseline_values(metrics_from_confusion(cms))
+    nulls = {"relabel": (_baseline_values(metrics_from_confusion(relabel_confusion(cms, perms))),
+                         n_relabelings is None)}
+    if n_shuffle_cms is not None:
+        nulls["shuffle"] = (_baseline_values(metrics_from_confusion(n_shuffle_cms)), False)
+    result = {}
+    for name in BASELINE_METRICS:
+        result[name] = {"observed": observed[name]}
+        for kind, (null, exhaustive) in nulls.items():
+            result[name][kind + "_mean"] = null[name].mean(axis=-1)
+            result[name][kind + "_p"] = _p_value(null[name], observed[name], name, exhaustive)
+    for kind, (null, _) in nulls.items():
+        result[kind + "_null"] = null
+    return result
+
+@instrumented("random_baseline")
+def cohort_random_baseline(subjects, doctor_hypno_list, hypno_pred_list, n_shuffles=1000,
+                           n_relabelings=None, seed=None):
+    # Table of the random baseline of every subject (rows: subject, metric). Relabeling is computed
+    # for the whole cohort at once, epoch shuffles subject by subject (seed + subject index).
+    cms = cohort_confusion(doctor_hypno_list, hypno_pred_list)
+    shuffles = None
+    if n_shuffles:
+        shuffles = np.stack([shuffle_confusion(doctor, pred, n_shuffles, None if seed is None else seed + i)
+                             for i, (doctor, pred) in enumerate(zip(doctor_hypno_list, hypno_pred_list))])
+    baseline = random_baseline(cms, shuffles, n_relabelings, seed)
+    frames = {name: pd.DataFrame(baseline[name], index=pd.Index(list(subjects), name="subject"))
+              for name in BASELINE_METRICS}
+    return pd.concat(frames, names=["metric"]).swaplevel().sort_index(level=0, sort_remaining=False)
+
+METRICS_COLUMNS = ["ID записи", "TP", "FP", "FN", "TN" , "Чувствительность Se (R)", "Специфичность P(PPV)",
+                   "Доля ложных распознаваний FPR", "Точность: Matches Yasa & Doctor/Total"]
+
+def _metrics_columns(metrics):
+    # Metric columns of the table (everything except the ID), one value per confusion matrix
+    # "Sensitivity"  in ГОСТ P MЭК 60601 2-47-2017 (tp/(tp + fn)) = Recall
+    # "Specificity" in ГОСТ P MЭК 60601 2-47-2017 (tp/(tp + fp)) = Precision, ie Positive Predictive Value (PPV)
+    values = [metrics["micro"][name] for name in ["TP", "FP", "FN", "TN"]]
+    values += [metrics["macro"]["recall"], metrics["macro"]["PPV"], metrics["macro"]["FPR"], metrics["accuracy"]]
+    return values
+
+def cohort_metrics_table(subjects, cms):
+    # Table with a row per subject computed from the (subjects, 5, 5) confusion tensor,
+    # followed by the mean over the subjects ("Среднее") and the metrics of the pooled
+    # confusion matrix of the whole cohort ("Всего")
+    table = dict(zip(METRICS_COLUMNS[1:], _metrics_columns(metrics_from_confusion(cms))))
+    df = pd.DataFrame(table)
+    df.insert(0, METRICS_COLUMNS[0], [re.sub(r'[A-Za-z]', '', subject) for subject in subjects])
+
+    #TP, FP, FN, TN
+    cols_to_round_0 = METRICS_COLUMNS[1:5]
+    # "Чувствительность Se (R)", "Специфичность P(PPV)",
+    # "Доля ложных распознаваний FPR", "Точность: Matches Yasa & Doctor/Total"
+    cols_to_round_2 = METRICS_COLUMNS[5:]
+    df[cols_to_round_0] = df[cols_to_round_0].astype(float).round(0)
+    df[cols_to_round_2] = df[cols_to_round_2].astype(float).round(2)
+
+    means = df[cols_to_round_0].mean().round(0)
+    means2 = df[cols_to_round_2].mean().round(2)
+    pooled = _metrics_columns(metrics_from_confusion(np.asarray(cms).sum(axis=0)))
+    summary = pd.DataFrame([['Среднее'] + list(means) + list(means2),
+                            ['Всего'] + [float(value) for value in pooled[:4]]
+                            + [round(float(value), 2) for value in pooled[4:]]],
+                           columns=METRICS_COLUMNS)
+    return pd.concat([df, summary], ignore_index=True)
+
+# Bootstrap confidence intervals of the table columns and kappa, from the per-subject confusion matrices
+CI_COLUMNS = METRICS_COLUMNS[1:] + ["Каппа"]
+
+def _ci_columns(metrics):
+    # (..., columns) array of CI_COLUMNS
+    return np.stack([np.asarray(value, dtype=float) for value in _metrics_columns(metrics)]
+                    + [np.asarray(metrics["kappa"], dtype=float)], axis=-1)
+
+def bootstrap_weights(n_items, n_boot, seed=None):
+    # (n_boot, n_items) counts of every item in each resample with replacement
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(n_items, np.full(n_items, 1 / n_items), size=n_boot)
+
+def subject_bootstrap(cms, n_boot=10000, seed=None):
+    # Resamples the subjects: (n_boot, columns) of the mean over the subjects ("Среднее") and of the
+    # pooled confusion matrix ("Всего"), both as matrix products of the count matrix with the
+    # per-subject values, without relabeling anything
+    cms = np.asarray(cms)
+    n_subjects, n_classes = cms.shape[0], cms.shape[-1]
+    weights = bootstrap_weights(n_subjects, n_boot, seed)
+    means = weights @ _ci_columns(metrics_from_confusion(cms)) / n_subjects
+    pooled = (weights @ cms.reshape(n_subjects, -1)).reshape(n_boot, n_classes, n_classes)
+    return means, _ci_columns(metrics_from_confusion(pooled))
+
+def block_confusion(doctor_hypno_scoring, hypno_pred, block_epochs=20, n_classes=N_STAGES):
+    # (blocks, n, n) confusion matrices of consecutive blocks of block_epochs epochs
+    blocks = np.arange(len(doctor_hypno_scoring)) // block_epochs
+    n_blocks = blocks[-1] + 1 if len(blocks) else 0
+    codes = (blocks * n_classes + np.asarray(doctor_hypno_scoring, dtype=np.int64)) * n_classes \
+        + np.asarray(hypno_pred, dtype=np.int64)
+    return np.bincount(codes, minlength=n_blocks * n_classes * n_classes).reshape(n_blocks, n_classes, n_classes)
+
+def _resample_blocks(block_cms, n_boot, seed):
+    # (n_boot, n, n) confusion matrices of one subject with its blocks resampled
+    n_blocks, n_classes = block_cms.shape[0], block_cms.shape[-1]
+    weights = bootstrap_weights(n_blocks, n_boot, seed)
+    return (weights @ block_cms.reshape(n_blocks, -1)).reshape(n_boot, n_classes, n_classes)
+
+def epoch_block_bootstrap(doctor_hypno_list, hypno_pred_list, n_boot=1000, block_epochs=20, seed=None, jobs=1):
+    # Resamples blocks of consecutive epochs (20 epochs = 10 min keep the dependence between
+    # neighbouring epochs) within every subject: (n_boot, columns) of the mean over the subjects.
+    # Subjects are resampled in `jobs` processes.
+    seeds = [None if seed is None else seed + i for i in range(len(doctor_hypno_list))]
+    block_cms = [block_confusion(doctor, pred, block_epochs) for doctor, pred in zip(doctor_hypno_list, hypno_pred_list)]
+    if jobs <= 1:
+        resampled = list(map(_resample_blocks, block_cms, repeat(n_boot), seeds))
     else:
-        print("Нет данных по классам.")
-        return 0
-
-def average_sensitivity(doctor_hypno_scoring, hypno_pred):
-    #Recall = Sensitivity: Recall = True Positives / (True Positives + False Negatives)
-    cm = confusion_matrix(doctor_hypno_scoring, hypno_pred)
-    # Multi-class
-    total = np.sum(cm)
-    sensitivities = []
-    for i in range(cm.shape[0]):
-        TP = cm[i, i]
-        FP = np.sum(cm[i, :]) - TP
-        FN = np.sum(cm[:, i]) - TP
-        TN = total - (TP + FP + FN)
-        sens = TP / (TP + FN) if (TP + FN) > 0 else 0
-        sensitivities.append(sens)
-
-    return np.round(np.mean(sensitivities), 2)
-
-def average_PPV(doctor_hypno_scoring, hypno_pred):
-    #Precision/Positive Predictive Value (PPV) = TP/(TP + FP)
-    cm = confusion_matrix(doctor_hypno_scoring, hypno_pred)
-    # Multi-class
-    total = np.sum(cm)
-    PPVs = []
-    for i in range(cm.shape[0]):
-        TP = cm[i, i]
-        FP = np.sum(cm[i, :]) - TP
-        FN = np.sum(cm[:, i]) - TP
-        TN = total - (TP + FP + FN)
-        PPV = TP / (TP + FP) if (TP + FP) > 0 else 0
-        PPVs.append(PPV)
-
-    return np.round(np.mean(PPVs), 2)
-
-def specificity(doctor_hypno_scoring, hypno_pred):
-    cm = confusion_matrix(doctor_hypno_scoring, hypno_pred)
-    # Multi-class
-    total = np.sum(cm)
-    specificities = []
-    for i in range(cm.shape[0]):
-        TP = cm[i, i]
-        FP = np.sum(cm[i, :]) - TP
-        FN = np.sum(cm[:, i]) - TP
-        TN = total - (TP + FP + FN)
-        specificity = TN / (TN + FP) if (TN + FP) > 0 else 0
-        specificities.append(specificity)
-
-    return np.round(np.mean(specificities), 2)
-
-def average_false_positive_rate(doctor_hypno_scoring, hypno_pred):
-    #FPR = FP/(FP + TN)
-    cm = confusion_matrix(doctor_hypno_scoring, hypno_pred)
-    # Multi-class
-    total = np.sum(cm)
-    false_positive_rates = []
-    for i in range(cm.shape[0]):
-        TP = cm[i, i]
-        FP = np.sum(cm[i, :]) - TP
-        FN = np.sum(cm[:, i]) - TP
-        TN = total - (TP + FP + FN)
-        fpr = FP / (FP + TN) if (FP + TN) > 0 else 0
-        false_positive_rates.append(fpr)
-
-    return np.round(np.mean(false_positive_rates), 2), TP, FP, FN, TN
-
-def compare_annotations(folder_metrics_path, subject):
-    yasa_annotations_path = os.path.join(folder_metrics_path, "{}_annotations_yasa.csv".format(subject))
-    doctor_annotations_path = os.path.join(folder_metrics_path, "{}_annotations_doctor.csv".format(subject))
-
-    yasa_annotations_data = read_annotations(yasa_annotations_path, 'csv')
-    doctor_annotations_data = read_annotations(doctor_annotations_path, 'csv')
-
-    # Проверяем, что файлы имеют одинаковую длину
-    if len(yasa_annotations_data) != len(doctor_annotations_data):
-        print(f"Внимание: файлы имеют разную длину!")
-        print(f"yasa_annotations_data: {len(yasa_annotations_data)} строк, doctor_annotations_data: {len(doctor_annotations_data)} строк")
-        print("Сравнение будет выполнено только для общего количества строк")
-        min_length = min(len(yasa_annotations_data), len(doctor_annotations_data))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            resampled = list(executor.map(_resample_blocks, block_cms, repeat(n_boot), seeds))
+    # (n_boot, subjects, n, n) -> per-subject values -> mean over the subjects
+    return _ci_columns(metrics_from_confusion(np.stack(resampled, axis=1))).mean(axis=1)
+
+def confidence_interval(samples, alpha=0.05):
+    # Percentile interval: (2, columns) lower and upper bounds
+    return np.percentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+@instrumented("bootstrap")
+def bootstrap_table(cms, doctor_hypno_list=None, hypno_pred_list=None, n_boot=10000, n_block_boot=0,
+                    block_epochs=20, seed=None, jobs=1, alpha=0.05):
+    # 95% intervals of CI_COLUMNS: rows "Среднее" and "Всего" (subjects resampled) and, with
+    # n_block_boot, "Среднее, блоки эпох" (epoch blocks resampled within the subjects)
+    means, pooled = subject_bootstrap(cms, n_boot, seed)
+    intervals = {"Среднее": confidence_interval(means, alpha), "Всего": confidence_interval(pooled, alpha)}
+    if n_block_boot:
+        intervals["Среднее, блоки эпох"] = confidence_interval(
+            epoch_block_bootstrap(doctor_hypno_list, hypno_pred_list, n_block_boot, block_epochs, seed, jobs), alpha)
+    low, high = f"{100 * alpha / 2:g}%", f"{100 * (1 - alpha / 2):g}%"
+    rows = {(name, bound): interval[i] for name, interval in intervals.items() for i, bound in enumerate([low, high])}
+    return pd.DataFrame(list(rows.values()), columns=CI_COLUMNS,
+                        index=pd.MultiIndex.from_tuples(list(rows), names=["Строка", "Граница"]))
+
+def ci_rows(ci):
+    # Rows of bootstrap_table for the metrics table of cohort_metrics_table, rounded like it
+    rows = ci[METRICS_COLUMNS[1:]].copy()
+    rows[METRICS_COLUMNS[1:5]] = rows[METRICS_COLUMNS[1:5]].round(0)
+    rows[METRICS_COLUMNS[5:]] = rows[METRICS_COLUMNS[5:]].round(2)
+    rows.insert(0, METRICS_COLUMNS[0], [f"{name} ДИ {bound}" for name, bound in ci.index])
+    return rows.reset_index(drop=True)
+
+def write_metrics_table(df, fname):
+    # Single write of the whole table, Excel or Parquet by the extension
+    if fname.endswith(".parquet"):
+        df.to_parquet(fname, index=False)
     else:
-        min_length = len(yasa_annotations_data)
+        df.to_excel(fname, index=False)
+
+# Keys of yasa.sleep_statistics, in its order
+SLEEP_STATISTICS = ["TIB", "SPT", "WASO", "TST", "N1", "N2", "N3", "REM", "NREM", "SOL",
+                    "Lat_N1", "Lat_N2", "Lat_N3", "Lat_REM", "%N1", "%N2", "%N3", "%REM", "%NREM", "SE", "SME"]
+
+def pad_hypnograms(hypnos, fill=-2):
+    # (subjects, max epochs) int8 array padded with `fill` (-2 = Unscored) and the lengths
+    lengths = np.array([len(hypno) for hypno in hypnos], dtype=np.int64)
+    padded = np.full((len(hypnos), lengths.max(initial=0)), fill, dtype=np.int8)
+    for row, hypno in zip(padded, hypnos):
+        row[:len(hypno)] = hypno
+    return padded, lengths
+
+@instrumented("sleep_statistics")
+def cohort_sleep_statistics(hypnos, lengths, sf_hyp=1 / 30, index=None):
+    # yasa.sleep_statistics of every row of the padded (subjects, epochs) hypnogram array at once,
+    # one row per subject with the SLEEP_STATISTICS columns. Equal to yasa.sleep_statistics,
+    # except that a hypnogram without sleep gives NaN instead of an error.
+    hypnos = np.asarray(hypnos)
+    n_subjects, n_epochs = hypnos.shape
+    if hypnos.size == 0:
+        return pd.DataFrame(np.nan, index=index if index is not None else range(n_subjects),
+                            columns=SLEEP_STATISTICS)
+    epochs = np.arange(n_epochs)
+    valid = epochs < np.asarray(lengths)[:, None]
+    sleep = (hypnos > 0) & valid
+    has_sleep = sleep.any(axis=1)
+
+    # TIB, first and last sleep
+    first_sleep = np.argmax(sleep, axis=1)
+    last_sleep = n_epochs - 1 - np.argmax(sleep[:, ::-1], axis=1)
+    in_spt = (epochs >= first_sleep[:, None]) & (epochs <= last_sleep[:, None])
+    counts = {"TIB": np.asarray(lengths, dtype=float),
+              "SPT": np.where(has_sleep, last_sleep - first_sleep + 1, np.nan),
+              "WASO": np.where(has_sleep, ((hypnos == 0) & in_spt).sum(axis=1), np.nan),
+              "TST": np.where(has_sleep, sleep.sum(axis=1), np.nan)}
+
+    # Duration of each sleep stage and latencies, over the whole hypnogram
+    for stage, code in [("N1", 1), ("N2", 2), ("N3", 3), ("REM", 4)]:
+        is_stage = (hypnos == code) & valid
+        counts[stage] = is_stage.sum(axis=1).astype(float)
+        counts["Lat_" + stage] = np.where(is_stage.any(axis=1), np.argmax(is_stage, axis=1), np.nan)
+    counts["NREM"] = counts["N1"] + counts["N2"] + counts["N3"]
+    counts["SOL"] = np.where(has_sleep, first_sleep, np.nan)
+
+    # Convert to minutes
+    stats = {key: value / (60 * sf_hyp) for key, value in counts.items()}
+
+    # Percentage
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for stage in ["N1", "N2", "N3", "REM", "NREM"]:
+            stats["%" + stage] = 100 * stats[stage] / stats["TST"]
+        stats["SE"] = 100 * stats["TST"] / stats["TIB"]
+        stats["SME"] = 100 * stats["TST"] / stats["SPT"]
+    return pd.DataFrame({key: stats[key] for key in SLEEP_STATISTICS}, index=index)
+
+# Cohort store: Parquet dataset of the epochs partitioned by subject
+# ({store}/epochs/subject=SN001/epochs.parquet) and one table of per-subject statistics and
+# metrics ({store}/subjects.parquet). Readers load only the columns and subjects they need.
+
+def _write_parquet(df, fname, index=False):
+    # Written to a temporary file first so that readers never see a partial table
+    df.to_parquet(fname + ".tmp", index=index)
+    os.replace(fname + ".tmp", fname)
+
+@instrumented("store_write")
+def write_epochs(folder_store, subject, **columns):
+    # Epoch-level columns of one subject, e.g. doctor=..., yasa=... (int8 stage codes).
+    # Other columns of the subject are kept when the number of epochs is the same.
+    folder = os.path.join(folder_store, "epochs", f"subject={subject}")
+    fname = os.path.join(folder, "epochs.parquet")
+    os.makedirs(folder, exist_ok=True)
+    df = pd.DataFrame({name: np.asarray(values) for name, values in columns.items()})
+    if os.path.exists(fname):
+        old = pd.read_parquet(fname)
+        if len(old) == len(df):
+            df = old.drop(columns=[name for name in columns if name in old.columns]).join(df)
+    df["epoch"] = np.arange(len(df), dtype=np.int32)
+    _write_parquet(df, fname)
+    return fname
+
+def read_epochs(folder_store, columns=None, subjects=None):
+    # Epochs of the cohort (or of `subjects`) with the subject column and only `columns`.
+    # Empty table if nothing was stored yet; a column that only some subjects have (e.g. the yasa
+    # column of a staging configuration) is null for the others.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    folder = os.path.join(folder_store, "epochs")
+    if columns is not None:
+        columns = ["subject", "epoch"] + [name for name in columns if name not in ("subject", "epoch")]
+    if not os.path.isdir(folder):
+        return pd.DataFrame(columns=columns or ["subject", "epoch"])
+    dataset = ds.dataset(folder, format="parquet", partitioning="hive")
+    filters = None if subjects is None else ds.field("subject").isin(list(subjects))
+    # Columns of every file of the subjects, not only of the first one; int8 stage codes for the columns
+    # none of them has
+    schema = pa.unify_schemas([dataset.schema] + [fragment.physical_schema
+                                                  for fragment in dataset.get_fragments(filter=filters)])
+    for name in columns or []:
+        if schema.get_field_index(name) < 0:
+            schema = schema.append(pa.field(name, pa.int8()))
+    dataset = ds.dataset(folder, schema=schema, format="parquet", partitioning="hive")
+    df = dataset.to_table(columns=columns, filter=filters).to_pandas()
+    df["subject"] = df["subject"].astype(str)
+    return df
+
+def epochs_by_subject(df, column, subjects):
+    # int8 array of `column` for every subject of `subjects`, None if the store has no epochs of it
+    # (or no value of this column)
+    groups = {subject: group.sort_values("epoch")[column] for subject, group in df.groupby("subject", sort=False)}
+    return [None if subject not in groups or groups[subject].isna().any()
+            else groups[subject].to_numpy(dtype=np.int8) for subject in subjects]
+
+def transitions_table(transitions, n_classes=N_STAGES):
+    # Long table of transition matrices (transition_matrix): {(subject, scorer): (n, n) counts} ->
+    # subject, scorer, from_stage, to_stage, count
+    stage_names = np.array(list(STAGE_CODES))[:n_classes]
+    keys = list(transitions)
+    counts = np.stack([np.asarray(transitions[key]) for key in keys]).reshape(len(keys), -1)
+    return pd.DataFrame({
+        "subject": np.repeat([subject for subject, _ in keys], n_classes * n_classes),
+        "scorer": np.repeat([scorer for _, scorer in keys], n_classes * n_classes),
+        "from_stage": np.tile(np.repeat(stage_names, n_classes), len(keys)),
+        "to_stage": np.tile(np.tile(stage_names, n_classes), len(keys)),
+        "count": counts.ravel().astype(np.int32)})
+
+def update_transitions(folder_store, table):
+    # Replaces the transitions of the subjects of `table` (transitions_table) in transitions.parquet.
+    # Only the main process of a script writes this table.
+    fname = os.path.join(folder_store, "transitions.parquet")
+    os.makedirs(folder_store, exist_ok=True)
+    if os.path.exists(fname):
+        old = pd.read_parquet(fname)
+        table = pd.concat([old[~old["subject"].isin(table["subject"])], table], ignore_index=True)
+    _write_parquet(table.sort_values(["subject", "scorer"], kind="stable"), fname)
+
+def read_transitions(folder_store, subjects=None):
+    # Stage transition counts of the doctor's and YASA hypnograms, e.g. the share of N2 -> N3 of YASA:
+    # df = read_transitions(store); df[(df["scorer"] == "yasa") & (df["from_stage"] == "N2")]
+    filters = None if subjects is None else [("subject", "in", list(subjects))]
+    return pd.read_parquet(os.path.join(folder_store, "transitions.parquet"), filters=filters)
+
+def update_subjects(folder_store, table):
+    # Inserts or overwrites the rows (index - subject) and columns of `table` in subjects.parquet.
+    # Only the main process of a script writes this table.
+    fname = os.path.join(folder_store, "subjects.parquet")
+    os.makedirs(folder_store, exist_ok=True)
+    table = table.copy()
+    table.index = table.index.astype(str)
+    table.index.name = "subject"
+    if os.path.exists(fname):
+        old = pd.read_parquet(fname)
+        table = pd.concat([old.drop(index=table.index, errors="ignore"),
+                           table.join(old.drop(columns=table.columns, errors="ignore"))])
+    _write_parquet(table.sort_index(), fname, index=True)
+
+def stage_bandpower(absolute, relative, hypno, n_classes=N_STAGES):
+    # Mean absolute and relative power of the epochs of every stage, (stages, channels, bands) each
+    # for (channels, epochs, bands) arrays, and the number of epochs of every stage (stages < 0 are left out)
+    hypno = np.asarray(hypno)
+    one_hot = (hypno[:, np.newaxis] == np.arange(n_classes)).astype(float)  # (epochs, stages)
+    counts = one_hot.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = [np.einsum("es,ceb->scb", one_hot, values) / counts[:, np.newaxis, np.newaxis]
+                 for values in (absolute, relative)]
+    return means[0], means[1], counts.astype(int)
+
+def bandpower_table(subject, channels, absolute, relative, hypnos):
+    # Per-subject table of the store: one row per scorer (e.g. doctor, yasa), stage and channel with
+    # n_epochs and the mean power of every band ({band} in uV^2, {band}_rel). absolute, relative:
+    # (channels, epochs, bands) of epoch_bandpower; hypnos: {scorer: (epochs of the recording, stages)}
+    stage_names = list(STAGE_CODES)
+    band_names = [name for _, _, name in BANDPOWER_BANDS]
+    rows = []
+    for scorer, (index, hypno) in hypnos.items():
+        mean_abs, mean_rel, counts = stage_bandpower(absolute[:, index], relative[:, index], hypno)
+        for stage, count in enumerate(counts):
+            for ch, channel in enumerate(channels):
+                row = dict(subject=subject, channel=channel, scorer=scorer, stage=stage_names[stage],
+                           n_epochs=int(count))
+                row.update(zip(band_names, mean_abs[stage, ch]))
+                row.update(zip([name + "_rel" for name in band_names], mean_rel[stage, ch]))
+                rows.append(row)
+    table = pd.DataFrame(rows)
+    bands = band_names + [name + "_rel" for name in band_names]
+    table[bands] = table[bands].astype(np.float32)
+    return table
+
+@instrumented("store_write")
+def write_bandpower(folder_store, subject, table):
+    # Band power table of one subject (bandpower_table) in the cohort store, replaced as a whole
+    folder = os.path.join(folder_store, "bandpower", f"subject={subject}")
+    fname = os.path.join(folder, "bandpower.parquet")
+    os.makedirs(folder, exist_ok=True)
+    _write_parquet(table.drop(columns="subject"), fname)
+    return fname
+
+def read_bandpower(folder_store, columns=None, subjects=None):
+    # Band power tables of the cohort (or of `subjects`) with the subject column, e.g.
+    # df = read_bandpower(store, ["sigma_rel"]); df[df["stage"] == "N2"].groupby("scorer")["sigma_rel"].mean()
+    folder = os.path.join(folder_store, "bandpower")
+    filters = None if subjects is None else [("subject", "in", list(subjects))]
+    if columns is not None:
+        columns = ["subject", "channel", "scorer", "stage", "n_epochs"] + [
+            name for name in columns if name not in ("subject", "channel", "scorer", "stage", "n_epochs")]
+    df = pd.read_parquet(folder, columns=columns, filters=filters)
+    df["subject"] = df["subject"].astype(str)
+    return df
+
+def read_subjects(folder_store, columns=None):
+    # Per-subject statistics and metrics, index - subject, e.g.
+    # df = read_subjects(store, ["%N3", "kappa"]); df.loc[df["kappa"] < 0.6, "%N3"].mean()
+    return pd.read_parquet(os.path.join(folder_store, "subjects.parquet"), columns=columns)
 
-    # Сравниваем построчно и выводим результат
-    for i in range(min_length):
-        is_match = yasa_annotations_data[i] == doctor_annotations_data[i]
-        #print(f"{i + 1:6} | {yasa_annotations_data[i]:11} | {doctor_annotations_data[i]:11} | {is_match}")
+def subject_metrics(subjects, cms):
+    # Per-subject macro metrics and agreement of the (subjects, 5, 5) confusion tensor for the store
+    metrics = metrics_from_confusion(cms)
+    table = {name: metrics["macro"][name] for name in ["recall", "PPV", "FPR", "F1"]}
+    table.update(accuracy=metrics["accuracy"], kappa=metrics["kappa"],
+                 n_epochs=np.asarray(cms).sum(axis=(-2, -1)))
+    return pd.DataFrame(table, index=pd.Index(list(subjects), name="subject"))
 
-        # Или просто вывод True/False для каждой строки:
-        # print(is_match)
+def disagreement_segments(doctor_hypno_scoring, hypno_pred):
+    # Runs of consecutive epochs where the stages differ: (segments, 2) array of first epoch and length
+    mismatch = np.asarray(doctor_hypno_scoring) != np.asarray(hypno_pred)
+    edges = np.diff(np.concatenate([[0], mismatch.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    return np.column_stack([starts, np.flatnonzero(edges == -1) - starts])
 
-    # Дополнительная статистика
-    matches = sum(1 for i in range(min_length) if yasa_annotations_data[i] == doctor_annotations_data[i])
-    total = min_length
-    accuracy = matches / total if total > 0 else 0
+def transition_matrix(hypno, n_classes=N_STAGES):
+    # (n, n) counts of stage i followed by stage j in the next epoch, epochs without a stage are skipped
+    hypno = np.asarray(hypno)
+    pairs = (hypno[:-1] >= 0) & (hypno[1:] >= 0)
+    return stage_confusion(hypno[:-1][pairs], hypno[1:][pairs], n_classes)
 
-    #print(f"\nСтатистика сравнения:")
-    #print(f"Всего строк: {total}")
-    #print(f"Совпадений: {matches}")
-    #print(f"Несовпадений: {total - matches}")
-    print(f"Точность совпадения: {accuracy:.2%}")
+def agreement(doctor_hypno_scoring, hypno_pred, n_classes=N_STAGES):
+    # Agreement of two hypnograms of the same epochs: matches, accuracy, disagreement segments
+    # and the transition matrices of both
+    doctor = np.asarray(doctor_hypno_scoring)
+    pred = np.asarray(hypno_pred)
+    if len(doctor) != len(pred):
+        raise ValueError(f"{len(doctor)} doctor's epochs, {len(pred)} yasa epochs")
+    matches = int(np.count_nonzero(doctor == pred))
+    total = len(doctor)
+    return {"matches": matches, "total": total, "accuracy": matches / total if total > 0 else 0,
+            "segments": disagreement_segments(doctor, pred),
+            "transitions_doctor": transition_matrix(doctor, n_classes),
+            "transitions_yasa": transition_matrix(pred, n_classes)}
 
-    return round(accuracy, 2)
+def write_cmp_annotations(fname, accuracies):
+    # cmp_annotations.txt of a whole batch in one write, None (failed subjects) are skipped
+    lines = ["doctor's, yasa annotations: matches / total\n"]  # Заголовок
+    lines += [f"{accuracy}\n" for accuracy in accuracies if accuracy is not None]
+    with open(fname, 'w', newline='', encoding='utf-8') as f:
+        f.write("".join(lines))
@@ -0,0 +1,632 @@
+#Stages of the pipeline with the folders taken from a JSON config (see load_config):
+#stage - preprocessing, doctor's and YASA hypnograms, spectrograms, annotations (script 0)
+#metrics - metrics table of YASA vs doctor's annotations (script 1)
+#stats - sleep statistics of the doctor's and YASA hypnograms (script 2)
+#bands - band power of every epoch averaged by the doctor's and YASA stages
+#report - PDF reports of the sleep statistics (script 3)
+#Each run_* function takes what the previous stages computed in memory, see sleep.py
+
+import os
+import glob
+import json
+from functools import partial
+import numpy as np
+from functions import (lazy_import, instrumented, preprocessing, prepare_data_for_hypnogram, plot_hypnogram, plot_spectrogram,
+                       yasa_staging, staging_picks, load_staging, agreement, subject_name, run_subjects,
+                       EEG_CHANNEL, stage_signature, stage_is_fresh, record_stage, render_job, figure_path,
+                       FigureRenderer, spectrogram_store, write_epochs, read_epochs, epochs_by_subject, update_subjects,
+                       read_subjects, align_epochs, align_hypnograms, misaligned, UNSCORED, transitions_table,
+                       update_transitions, write_cmp_annotations, write_annotations, cohort_confusion, cohort_metrics_table,
+                       write_metrics_table, subject_metrics, bootstrap_table, ci_rows, cohort_random_baseline,
+                       pad_hypnograms, cohort_sleep_statistics, epoch_bandpower, bandpower_table,
+                       write_bandpower)
+
+# Heavy libraries are imported by the stages that use them, see lazy_import
+pd = lazy_import("pandas")
+
+# Folders and files, relative to "root" (itself relative to the config file) unless absolute
+DEFAULT_CONFIG = {
+    "root": ".",
+    "data": os.path.join("data", "haaglanden-medisch-centrum-sleep-staging-database-1.1", "recordings"),
+    "pics": "pics",
+    "metrics": "yasa_annotations_metrics",
+    "statistics": "sleep_statistics",
+    "pdf": "PDF",
+    # Preprocessed (resampled, filtered) recordings, see preprocessing()
+    "cache": "cache",
+    # Scratch memory-mapped EDF samples, see preprocessing()
+    "memmap": "memmap",
+    # Parquet epochs and per-subject table of the cohort
+    "store": "cohort_store",
+    # Inputs, parameters and outputs of every stage, see stage_is_fresh()
+    "manifest": "manifest.sqlite",
+    # DejaVu Sans for cyrillic in the PDF reports
+    "font": os.path.join("dejavu-sans-ttf-2.37", "ttf", "DejaVuSans.ttf"),
+}
+# Used when no config is given and it exists in the current folder
+DEFAULT_CONFIG_FILE = "sleep.json"
+
+# Preprocessing of the recordings
+PREPROCESSING = dict(picks=[EEG_CHANNEL], sfreq=100, l_freq=0.3, h_freq=45)
+# Channels of the YASA staging (keyword arguments of yasa_staging), see add_staging_arguments
+STAGING = dict(eeg_names=[EEG_CHANNEL], eog_name=None, emg_name=None)
+
+def preprocessing_picks(staging):
+    # Channels read from the recordings: those of the staging, EEG_CHANNEL is always read for the spectrogram
+    return list(dict.fromkeys([EEG_CHANNEL] + staging_picks(**staging)))
+
+def preprocess_subject(files, config, staging):
+    # Recording of the subject preprocessed with the rate and band of PREPROCESSING, channels of the staging
+    params = {key: value for key, value in PREPROCESSING.items() if key != "picks"}
+    return preprocessing(files["edf"], cache_dir=config["cache"], picks=preprocessing_picks(staging),
+                         memmap_dir=config["memmap"], **params)
+
+def load_config(fname=None):
+    # DEFAULT_CONFIG updated with the JSON config, every path absolute
+    config = dict(DEFAULT_CONFIG)
+    base = os.getcwd()
+    if fname is None and os.path.exists(DEFAULT_CONFIG_FILE):
+        fname = DEFAULT_CONFIG_FILE
+    if fname is not None:
+        with open(fname, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+        base = os.path.dirname(os.path.abspath(fname))
+    root = config["root"] = os.path.abspath(os.path.join(base, config["root"]))
+    for key in DEFAULT_CONFIG:
+        if key != "root":
+            config[key] = os.path.abspath(os.path.join(root, config[key]))
+    for key in ["pics", "metrics", "statistics", "pdf"]:
+        os.makedirs(config[key], exist_ok=True)
+    return config
+
+def select_subjects(config, first=1, last=154, pattern=None):
+    # SN{first}..SN{last}, or the recordings of the data folder matching `pattern` (e.g. "SN00*")
+    if pattern is None:
+        return [subject_name(idx) for idx in range(first, last + 1)]
+    fnames = glob.glob(os.path.join(config["data"], pattern + ".edf"))
+    return sorted(os.path.splitext(os.path.basename(fname))[0] for fname in fnames)
+
+def staging_suffix(staging):
+    # Suffix of the staging file of a staging configuration, none for the default STAGING
+    return "" if staging == STAGING else "_" + stage_signature([], staging)[:8]
+
+def staging_column(staging):
+    # Column of the YASA stages of a staging configuration in the epochs of the cohort store
+    return "yasa" + staging_suffix(staging or STAGING)
+
+def subject_files(config, subject, staging=None):
+    # Every file of a subject; the YASA staging of every staging configuration has its own file
+    return dict(
+        edf=os.path.join(config["data"], "{}.edf".format(subject)),
+        txt=os.path.join(config["data"], "{}_sleepscoring.txt".format(subject)),
+        hypnogram_doctor=os.path.join(config["pics"], "hypnogram_{}_doctor.png".format(subject)),
+        spectrogram_doctor=os.path.join(config["pics"], "spectrogram_{}_doctor.png".format(subject)),
+        hypnogram_yasa=os.path.join(config["pics"], "hypnogram_{}_yasa.png".format(subject)),
+        annotations_doctor=os.path.join(config["metrics"], "{}_annotations_doctor.csv".format(subject)),
+        annotations_yasa=os.path.join(config["metrics"], "{}_annotations_yasa.csv".format(subject)),
+        metrics_report=os.path.join(config["metrics"], "{}_metrics_report_yasa.txt".format(subject)),
+        spectrogram=os.path.join(config["metrics"], "{}_spectrogram.npz".format(subject)),
+        staging=os.path.join(config["metrics"],
+                             "{}_staging_yasa{}.npz".format(subject, staging_suffix(staging or STAGING))),
+        statistics=os.path.join(config["statistics"], "{}_sleep_statistics.json".format(subject)),
+        pdf=os.path.join(config["pdf"], "{}_sleep_statistics.pdf".format(subject)),
+    )
+
+def _int8(stages):
+    return None if stages is None else np.asarray(stages, dtype=np.int8)
+
+class SubjectResult:
+    # What a subject hands from one stage to the next in memory: the int8 hypnograms of the doctor's scoring
+    # and of the YASA staging (whole recording), the stages of the epochs scored by both (aligned), the report
+    # of align_epochs, the YASA epoch of every doctor's epoch (yasa_index, -1 if none), the accuracy,
+    # the disagreement segments, the stage transition matrices ({"doctor": (5, 5), "yasa": (5, 5)}) and
+    # the classification report. Persisted by write() in one Parquet write.
+    __slots__ = ("subject", "doctor", "yasa", "doctor_aligned", "yasa_aligned", "alignment", "yasa_index",
+                 "accuracy", "segments", "transitions", "report")
+
+    def __init__(self, subject, doctor=None, yasa=None, doctor_aligned=None, yasa_aligned=None, alignment=None,
+                 yasa_index=None, accuracy=None, segments=None, transitions=None, report=None):
+        self.subject = subject
+        self.doctor = _int8(doctor)
+        self.yasa = _int8(yasa)
+        self.doctor_aligned = _int8(doctor_aligned)
+        self.yasa_aligned = _int8(yasa_aligned)
+        self.alignment = alignment
+        self.yasa_index = yasa_index
+        self.accuracy = accuracy
+        self.segments = segments
+        self.transitions = transitions
+        self.report = report
+
+    def yasa_on_doctor(self):
+        # YASA stage of every doctor's epoch, UNSCORED where YASA has no epoch
+        return np.where(self.yasa_index >= 0, self.yasa[self.yasa_index], UNSCORED).astype(np.int8)
+
+    def write(self, folder_store, staging=None):
+        # The aligned stages go to the epochs of the cohort store, the only per-subject file.
+        # The YASA stages of every staging configuration have their own column (staging_column).
+        return write_epochs(folder_store, self.subject, doctor=self.doctor_aligned,
+                            **{staging_column(staging): self.yasa_aligned})
+
+    def write_annotations(self, files):
+        # Text files of the earlier versions (--annotations): {subject}_annotations_doctor.csv,
+        # {subject}_annotations_yasa.csv and {subject}_metrics_report_yasa.txt, one write each
+        write_annotations(files["annotations_doctor"], self.doctor)
+        write_annotations(files["annotations_yasa"], self.yasa_on_doctor())
+        with open(files["metrics_report"], 'w') as f:
+            f.write(self.report)
+        return [files["annotations_doctor"], files["annotations_yasa"], files["metrics_report"]]
+
+# stage
+
+def stage_subject(subject, config, force=False, resume=False, preset="default", staging=None, annotations=False):
+    # Returns the accuracy, the figures to draw (render_job, see FigureRenderer) and the SubjectResult,
+    # None when the subject is up to date. staging - channels of the YASA staging (STAGING by default),
+    # annotations - also write the text files of SubjectResult.write_annotations
+    staging = staging or STAGING
+    files = subject_files(config, subject, staging)
+    fname_manifest = config["manifest"]
+
+    # Skip the stages whose inputs and parameters did not change since the last run
+    params = PREPROCESSING
+    doctor_signature = stage_signature([files["edf"], files["txt"]], dict(params, preset=preset))
+    yasa_params = dict(params, staging="yasa" if staging == STAGING else staging, preset=preset)
+    if annotations:
+        yasa_params["annotations"] = True
+    yasa_signature = stage_signature([files["edf"], files["txt"]], yasa_params)
+    doctor_fresh, yasa_fresh, accuracy = False, False, None
+    if not force:
+        doctor_fresh, _ = stage_is_fresh(fname_manifest, subject, "doctor", doctor_signature, resume)
+        yasa_fresh, accuracy = stage_is_fresh(fname_manifest, subject, "yasa", yasa_signature, resume)
+    if doctor_fresh and yasa_fresh:
+        print(f"{subject}: результаты актуальны, пропускаем")
+        return accuracy, [], None
+
+    #Get and process the data (channels, resampling, filter)
+    [raw, chan, sf] = preprocess_subject(files, config, staging)
+
+    #Mapping
+    # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
+    doctor_hypno_scoring, onsets = prepare_data_for_hypnogram(files["txt"], return_onsets=True)
+
+    # Figures are drawn in the background by FigureRenderer
+    renders = []
+    if not doctor_fresh:
+        #Hypnogram
+        renders.append(render_job(plot_hypnogram, files["hypnogram_doctor"], doctor_hypno_scoring))
+
+        #Spectrogram
+        # Computed once into {subject}_spectrogram.npz, the figure and the PDF report are drawn from it
+        spectrogram_store(raw, files["spectrogram"], source=stage_signature([files["edf"]], params))
+        renders.append(render_job(plot_spectrogram, files["spectrogram_doctor"], doctor_hypno_scoring,
+                                  files["spectrogram"]))
+        record_stage(fname_manifest, subject, "doctor", doctor_signature,
+                     [figure_path(files["hypnogram_doctor"], preset),
+                      figure_path(files["spectrogram_doctor"], preset), files["spectrogram"]])
+    if yasa_fresh:
+        return accuracy, renders, None
+
+    #Automatic sleep staging with YASA
+    # Hypnogram and probabilities are stored in {subject}_staging_yasa.npz and reused by the metrics
+    hypno_predicted = yasa_staging(None, raw, cache_path=files["staging"],
+                                   source=stage_signature([files["edf"]], params), **staging)
+    renders.append(render_job(plot_hypnogram, files["hypnogram_yasa"], hypno_predicted))
+
+    # YASA epoch of every doctor's epoch by its onset, -1 if YASA has none (see align_epochs)
+    index, alignment = align_epochs(onsets, len(hypno_predicted))
+    if misaligned(alignment):
+        print(f"{subject}: эпохи не совпадают {alignment}")
+    scored = index >= 0
+    result = SubjectResult(subject, doctor_hypno_scoring, hypno_predicted, doctor_hypno_scoring[scored],
+                           np.asarray(hypno_predicted)[index[scored]], alignment, index)
+
+    # Metrics
+    from sklearn.metrics import classification_report
+    result.report = classification_report(result.doctor_aligned.astype(int), result.yasa_aligned.astype(int),
+                                          output_dict=False)
+    print(result.report)
+
+    # Agreement of doctor's and yasa's annotations: accuracy, disagreement segments, transition matrices
+    agree = agreement(result.doctor_aligned, result.yasa_aligned)
+    print(f"Точность совпадения: {agree['accuracy']:.2%}")
+    result.accuracy = round(agree["accuracy"], 2)
+    result.segments = agree["segments"]
+    result.transitions = dict(doctor=agree["transitions_doctor"], yasa=agree["transitions_yasa"])
+
+    # Everything of the subject is written at once
+    outputs = [result.write(config["store"], staging)]
+    if annotations:
+        outputs += result.write_annotations(files)
+    record_stage(fname_manifest, subject, "yasa", yasa_signature,
+                 outputs + [figure_path(files["hypnogram_yasa"], preset), files["staging"]], result=result.accuracy)
+    return result.accuracy, renders, result
+
+def run_stage(config, subjects, jobs=1, render_jobs=2, preset="default", force=False, resume=False, staging=None,
+              annotations=False):
+    # Returns the SubjectResult of the subjects staged in this run and the subjects skipped as up to date
+    # (their hypnograms are in the cohort store), subjects that failed are in neither
+    # Figures of a subject are queued as soon as it is done, only the end of the batch waits for them
+    renderer = FigureRenderer(render_jobs, preset)
+    results = run_subjects(partial(stage_subject, config=config, force=force, resume=resume, preset=preset,
+                                   staging=staging, annotations=annotations),
+                           subjects, jobs, on_result=lambda result: renderer.submit_all(result[1]))
+    renderer.wait()
+    compare_annot_list = [result[0] if result is not None else None for result in results]
+    accuracies = {subject: accuracy for subject, accuracy in zip(subjects, compare_annot_list)
+                  if accuracy is not None}
+    if accuracies:
+        update_subjects(config["store"], pd.DataFrame({"cmp_accuracy": accuracies}))
+    # Runs of consecutive epochs where YASA disagrees with the doctor, for the recomputed subjects
+    staged = {subject: result[2] for subject, result in zip(subjects, results)
+              if result is not None and result[2] is not None}
+    segments = {subject: result.segments for subject, result in staged.items()}
+    if segments:
+        update_subjects(config["store"], pd.DataFrame(
+            {"disagreements": {subject: len(seg) for subject, seg in segments.items()},
+             "longest_disagreement": {subject: seg[:, 1].max(initial=0) for subject, seg in segments.items()}}))
+        # Stage transitions of the doctor's and YASA hypnograms
+        update_transitions(config["store"], transitions_table(
+            {(subject, scorer): matrix for subject, result in staged.items()
+             for scorer, matrix in result.transitions.items()}))
+
+    # Written once for the whole batch, subjects that failed are skipped
+    write_cmp_annotations(os.path.join(config["metrics"], 'cmp_annotations.txt'), compare_annot_list)
+    fresh = [subject for subject, result in zip(subjects, results) if result is not None and result[2] is None]
+    return staged, fresh
+
+# metrics
+
+def metrics_subject(subject, config, staging=None):
+    # Returns the SubjectResult and the figures to draw (render_job), see FigureRenderer
+    staging = staging or STAGING
+    files = subject_files(config, subject, staging)
+    #Get and process the data (channels, resampling, filter)
+    [raw, chan, sf] = preprocess_subject(files, config, staging)
+
+    #Mapping
+    # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
+    doctor_hypno_scoring, onsets = prepare_data_for_hypnogram(files["txt"], return_onsets=True)
+    #Automatic sleep staging with YASA
+    # Staging of the stage step is reused from {subject}_staging_yasa.npz when the recording did not change
+    hypno_predicted = yasa_staging(None, raw, cache_path=files["staging"],
+                                   source=stage_signature([files["edf"]], PREPROCESSING), **staging)
+    renders = [render_job(plot_hypnogram, files["hypnogram_yasa"], hypno_predicted)]
+
+    # Doctor's and YASA stages of the same 30-sec epochs of the recording (see align_epochs)
+    doctor, pred, alignment = align_hypnograms(doctor_hypno_scoring, onsets, hypno_predicted)
+    if misaligned(alignment):
+        print(f"{subject}: эпохи не совпадают {alignment}")
+
+    # Only the hypnograms go back to the main process, metrics are computed for the whole cohort
+    result = SubjectResult(subject, doctor_hypno_scoring, hypno_predicted, doctor, pred, alignment)
+    result.write(config["store"], staging)
+    return result, renders
+
+def _labels_from_store(config, subjects, staging=None):
+    # Aligned hypnograms of the cohort store, only the doctor and the yasa column of `staging` are read.
+    # Subjects never staged with this configuration are left out.
+    column = staging_column(staging)
+    epochs = read_epochs(config["store"], ["doctor", column], subjects)
+    doctors = epochs_by_subject(epochs, "doctor", subjects)
+    preds = epochs_by_subject(epochs, column, subjects)
+    return {subject: SubjectResult(subject, doctor_aligned=doctor, yasa_aligned=pred)
+            for subject, doctor, pred in zip(subjects, doctors, preds) if doctor is not None and pred is not None}
+
+def run_metrics(config, subjects, labels=None, from_store=False, jobs=1, render_jobs=2, preset="default",
+                bootstrap=10000, block_bootstrap=0, block_epochs=20, seed=0, parquet=False, random_baseline=False,
+                staging=None):
+    # Metrics table of the subjects. Hypnograms come from `labels` (SubjectResult, e.g. returned by run_stage), then
+    # from the cohort store with from_store, otherwise the subjects are staged again (channels of `staging`).
+    labels = dict(labels or {})
+    missing = [subject for subject in subjects if subject not in labels]
+    if missing and from_store:
+        labels.update(_labels_from_store(config, missing, staging))
+    elif missing:
+        renderer = FigureRenderer(render_jobs, preset)
+        results = run_subjects(partial(metrics_subject, config=config, staging=staging), missing, jobs,
+                               on_result=lambda result: renderer.submit_all(result[1]))
+        renderer.wait()
+        labels.update({subject: result[0] for subject, result in zip(missing, results) if result is not None})
+    # Subjects that failed are skipped
+    done = [subject for subject in subjects if subject in labels]
+    doctor_list = [labels[subject].doctor_aligned for subject in done]
+    pred_list = [labels[subject].yasa_aligned for subject in done]
+
+    # (subjects, 5, 5) confusion tensor in one pass, one row per subject + Среднее and Всего
+    cms = cohort_confusion(doctor_list, pred_list)
+    df = cohort_metrics_table(done, cms)
+    ci = None
+    if bootstrap and done:
+        ci = bootstrap_table(cms, doctor_list, pred_list, n_boot=bootstrap, n_block_boot=block_bootstrap,
+                             block_epochs=block_epochs, seed=seed, jobs=jobs)
+        df = pd.concat([df, ci_rows(ci)], ignore_index=True)
+    print(df)
+    if done:
+        table = subject_metrics(done, cms)
+        # Offsets between the doctor's scoring and the YASA epochs, see align_epochs
+        aligned = [subject for subject in done if labels[subject].alignment is not None]
+        if aligned:
+            alignment = pd.DataFrame([labels[subject].alignment for subject in aligned], index=aligned)
+            table = table.join(alignment.add_prefix("align_"))
+        update_subjects(config["store"], table)
+
+    # Save in Excel
+    yasa_metrics_path = os.path.join(config["metrics"], "Total_metrics_report_yasa_test.xlsx")
+    write_metrics_table(df, yasa_metrics_path)
+    if ci is not None:
+        write_metrics_table(ci.reset_index(), os.path.join(config["metrics"], "Total_metrics_ci_yasa_test.xlsx"))
+    if parquet:
+        write_metrics_table(df, yasa_metrics_path.replace(".xlsx", ".parquet"))
+
+    if random_baseline and done:
+        # Chance level of every metric: all stage mappings at once and seeded epoch shuffles
+        baseline = cohort_random_baseline(done, doctor_list, pred_list, n_shuffles=1000, seed=seed)
+        print(baseline)
+        baseline.to_excel(os.path.join(config["metrics"], "Random_baseline_yasa.xlsx"))
+    return df
+
+# stats
+
+def _statistics_hypnograms(doctor_aligned, yasa_aligned):
+    # Doctor's and YASA stages of the same epochs (scored by both, see align_hypnograms), so that both
+    # statistics describe the same period whatever the path: in memory, files or the cohort store.
+    # The first scored epoch is left out, as script 2 always did.
+    return doctor_aligned[1:], None if yasa_aligned is None else yasa_aligned[1:]
+
+def load_hypnograms(subject, config, from_store=False, staging=None):
+    # (doctor's, yasa) hypnograms of the subject for the statistics, yasa of the staging configuration
+    # `staging`. yasa is None when the subject is not staged, the doctor's scoring is then used whole.
+    files = subject_files(config, subject, staging)
+    if from_store:
+        labels = _labels_from_store(config, [subject], staging)
+        if subject not in labels:
+            raise ValueError(f"{subject} is not in the cohort store")
+        return _statistics_hypnograms(labels[subject].doctor_aligned, labels[subject].yasa_aligned)
+    # Mapping
+    # 0 = Wake, 1 = N1 sleep, 2 = N2 sleep, 3 = N3 sleep and 4 = REM sleep
+    hypno_filtered, onsets = prepare_data_for_hypnogram(files["txt"], return_onsets=True)
+    if not os.path.exists(files["staging"]):
+        return _statistics_hypnograms(hypno_filtered, None)
+    doctor, pred, _ = align_hypnograms(hypno_filtered, onsets, load_staging(files["staging"])[0])
+    return _statistics_hypnograms(doctor, pred)
+
+def run_stats(config, subjects, labels=None, from_store=False, jobs=1, staging=None):
+    # Sleep statistics of the doctor's hypnograms (rows - subjects), the YASA ones are stored side by side.
+    # Hypnograms come from `labels` (SubjectResult, e.g. returned by run_stage), otherwise they are loaded.
+    labels = labels or {}
+    hypnos = {subject: _statistics_hypnograms(labels[subject].doctor_aligned, labels[subject].yasa_aligned)
+              for subject in subjects if subject in labels and labels[subject].doctor_aligned is not None}
+    missing = [subject for subject in subjects if subject not in hypnos]
+    results = run_subjects(partial(load_hypnograms, config=config, from_store=from_store, staging=staging),
+                           missing, jobs)
+    hypnos.update({subject: result for subject, result in zip(missing, results) if result is not None})
+    done = [subject for subject in subjects if subject in hypnos]
+
+    # Statistics of all the subjects at once, assuming that we have one-value per 30-second.
+    padded, lengths = pad_hypnograms([hypnos[subject][0] for subject in done])
+    stats = cohort_sleep_statistics(padded, lengths, sf_hyp=1/30, index=done)
+    staged = [subject for subject in done if hypnos[subject][1] is not None]
+    padded, lengths = pad_hypnograms([hypnos[subject][1] for subject in staged])
+    stats_yasa = cohort_sleep_statistics(padded, lengths, sf_hyp=1/30, index=staged)
+
+    # JSON
+    for subject, stat in stats.iterrows():
+        fname_stat = subject_files(config, subject)["statistics"]
+        with open(fname_stat, 'w', encoding='utf-8') as f:
+            json.dump(stat.to_dict(), f, ensure_ascii=False, indent=4)
+        print(f"Статистика сохранена в {fname_stat}")
+
+    # Doctor's and YASA statistics side by side
+    side_by_side = pd.concat({"doctor": stats, "yasa": stats_yasa}, axis=1)
+    side_by_side.to_excel(os.path.join(config["statistics"], "cohort_sleep_statistics.xlsx"))
+
+    # The per-subject table of the store is written once, by the main process
+    if done:
+        update_subjects(config["store"], stats.join(stats_yasa.add_prefix("yasa_")))
+    return stats
+
+# bands
+
+def bands_subject(subject, config, staging=None, method="welch"):
+    # Band power of the EEG channels of the staging averaged by the doctor's and YASA stages
+    # (bandpower_table), written to the cohort store. The recording comes from the cache of
+    # preprocessing and the YASA hypnogram from {subject}_staging_yasa.npz when they are up to date.
+    staging = staging or STAGING
+    files = subject_files(config, subject, staging)
+    [raw, chan, sf] = preprocess_subject(files, config, staging)
+    doctor_hypno_scoring, onsets = prepare_data_for_hypnogram(files["txt"], return_onsets=True)
+    hypno_predicted = yasa_staging(None, raw, cache_path=files["staging"],
+                                   source=stage_signature([files["edf"]], PREPROCESSING), **staging)
+
+    channels = staging["eeg_names"]
+    absolute, relative = epoch_bandpower(raw, channels, method, files["spectrogram"],
+                                         source=stage_signature([files["edf"]], PREPROCESSING))
+    # Epochs of the recording with a stage: the doctor's ones by their onsets (see align_epochs), all of YASA
+    n_epochs = min(absolute.shape[1], len(hypno_predicted))
+    index, _ = align_epochs(onsets, n_epochs)
+    scored = index >= 0
+    hypnos = dict(doctor=(index[scored], doctor_hypno_scoring[scored]),
+                  yasa=(np.arange(n_epochs), np.asarray(hypno_predicted)[:n_epochs]))
+    table = bandpower_table(subject, channels, absolute, relative, hypnos)
+    write_bandpower(config["store"], subject, table)
+    return table
+
+def run_bands(config, subjects, jobs=1, staging=None, method="welch"):
+    # Band power tables of the subjects (rows - subject, channel, scorer, stage), one file per subject
+    # in cohort_store/bandpower (see read_bandpower), also returned as one DataFrame
+    results = run_subjects(partial(bands_subject, config=config, staging=staging, method=method), subjects, jobs)
+    tables = [table for table in results if table is not None]
+    return pd.concat(tables, ignore_index=True) if tables else None
+
+# report
+
+#Dict for sleep stat notations
+descriptions = {
+    "TIB": "Время в кровати",
+    "SPT": "Время с первого до последнего цикла сна",
+    "WASO": "Общая продолжительность бодрствования после засыпания",
+    "TST": "Общая продолжительность сна (N1 + N2 + N3 + REM)",
+    "N1": "Фаза сна N1",
+    "N2": "Фаза сна N2",
+    "N3": "Фаза сна N3",
+    "REM": "Фаза сна REM: быстрое движение глаз",
+    "NREM": "Фазы сна без REM: NREM = N1 + N2 + N3",
+    "SOL": "Время от начала процесса засыпания до первой стадии сна",
+    "Lat_N1": "Время/Латентность от начала записи до начала стадии сна N1",
+    "Lat_N2": "Время/Латентность от начала записи до начала стадии сна N2",
+    "Lat_N3": "Время/Латентность от начала записи до начала стадии сна N3",
+    "Lat_REM": "Время/Латентность от начала записи до начала стадии сна REM",
+    "%N1": "Общая продолжительность сна N1 (в %) от общей продолжительности сна",
+    "%N2": "Общая продолжительность сна N2 (в %) от общей продолжительности сна",
+    "%N3": "Общая продолжительность сна N3 (в %) от общей продолжительности сна",
+    "%REM": "Общая продолжительность сна REM (в %) от общей продолжительности сна",
+    "%NREM": "Общая продолжительность сна NREM = N1 + N2 + N3 (в %) от общей продолжительности сна",
+    "SE": "Эффективность сна = Общая продолжительность сна / Время в кровати * 100 (%)",
+    "SME": "Эффективность поддержания сна = Общая продолжительность сна / Время с первого до последнего цикла сна * 100 (%)"
+}
+
+# The spectrogram takes IMAGE_WIDTH mm of the page and is embedded at IMAGE_DPI
+IMAGE_WIDTH = 250
+IMAGE_DPI = 150
+
+def format_duration(value):
+    #Format time: hours and minutes
+    try:
+        minutes = float(value)
+        hours = int(minutes // 60)
+        remaining_minutes = round(minutes % 60)  # Округляем минуты
+        return f"{hours} часов {remaining_minutes} минут"
+    except (ValueError, TypeError):
+        return str(value)
+
+def new_report(font_path):
+    from fpdf import FPDF
+    # Create PDF object
+    pdf = FPDF(orientation='L')
+    # Register only the regular style of the DejaVu font
+    pdf.add_font('DejaVu', '', font_path)  # Убрали uni=True
+    return pdf
+
+def add_report_page(pdf, subject, stat, image_path):
+    from fpdf import XPos, YPos
+    pdf.add_page()
+    # Обязательно установка шрифта перед добавлением текста
+    pdf.set_font("DejaVu", size=12)
+    # Заголовок
+    pdf.cell(200, 10, text=f"Статистика сна для {subject}", new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+
+    # Subject info
+    pdf.cell(200, 10, text=f"Субъект: {subject}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    # Table
+    pdf.set_fill_color(200, 220, 255)
+    pdf.set_font("DejaVu", '', 12)  # Используем DejaVu для заголовков (обычный стиль)
+
+    pdf.cell(200, 10, "Параметр", border=1, new_x=XPos.RIGHT, new_y=YPos.TOP, align='C', fill=True)
+    pdf.cell(70, 10, "Значение", border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C', fill=True)
+
+    pdf.set_font("DejaVu", '', 11)  # Используем DejaVu для данных (обычный стиль)
+
+    # Data
+    if stat:
+        for key, value in stat.items():
+            pdf.multi_cell(200, 10, key, border=1, new_x=XPos.RIGHT, new_y=YPos.TOP, align='L')
+
+            if '%' in key:
+                display_value = f"{int(float(value))}%"  # выводим значение без форматирования
+            else:
+                display_value = format_duration(value)  # применяем форматирование
+
+            pdf.multi_cell(70, 10, display_value, border=1, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+
+    #Image
+    if image_path is not None:
+        pdf.ln(20)
+        pdf.image(image_path, x=10, y=None, w=IMAGE_WIDTH) # image_path, x=left, y=top, w=width. None means that aspect ratio is kept.
+
+@instrumented("pdf")
+def create_sleep_statistics_pdf(subject, stat, filename, image_path, font_path):
+    pdf = new_report(font_path)
+    add_report_page(pdf, subject, stat, image_path)
+
+    # Save PDF
+    pdf.output(filename)
+    print(f"{filename} создан")
+
+def report_image(subject, config):
+    # Spectrogram of the subject downscaled once to IMAGE_WIDTH mm at IMAGE_DPI into PDF/images;
+    # the copy is remade only when the 300-dpi figure is newer. None if there is no spectrogram.
+    files = subject_files(config, subject)
+    image_path = files["spectrogram_doctor"]
+
+    # The spectrogram missing in pics is drawn from the store of the stage step ({subject}_spectrogram.npz)
+    if not os.path.exists(image_path) and os.path.exists(files["spectrogram"]):
+        hypno = prepare_data_for_hypnogram(files["txt"])
+        plot_spectrogram(image_path, hypno, files["spectrogram"])
+    if not os.path.exists(image_path):
+        return None
+
+    folder_images = os.path.join(config["pdf"], "images")
+    os.makedirs(folder_images, exist_ok=True)
+    fname_small = os.path.join(folder_images, os.path.basename(image_path))
+    if not os.path.exists(fname_small) or os.path.getmtime(fname_small) < os.path.getmtime(image_path):
+        from PIL import Image
+        width = round(IMAGE_WIDTH / 25.4 * IMAGE_DPI)
+        with Image.open(image_path) as image:
+            if image.width > width:
+                image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            image.convert("RGB").save(fname_small, optimize=True)
+    return fname_small
+
+def load_statistics(subject, config, from_store=False):
+    # Sleep statistics of the stats step, None if there are none
+    if from_store:
+        # Only the statistics columns of the per-subject table are read
+        table = read_subjects(config["store"], columns=list(descriptions))
+        if subject not in table.index:
+            print(f"{subject} нет в {config['store']}")
+            return None
+        return table.loc[subject].to_dict()
+    fname_stat = subject_files(config, subject)["statistics"]
+    try:
+        with open(fname_stat, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        print(f"Файл {fname_stat} не найден")
+        return None
+
+def report_subject(subject, config, stats=None, from_store=False):
+    # Returns what the combined report needs: (subject, statistics, image)
+    # Statistics are taken from `stats` (subject -> dict) when given, otherwise loaded
+    stat = stats.get(subject) if stats else None
+    if stat is None:
+        stat = load_statistics(subject, config, from_store)
+    if stat is None:
+        return None
+
+    # Replace the key
+    stat_rus = {}
+    for key, value in stat.items():
+        desc = descriptions.get(key, key)
+        stat_rus[desc] = value
+
+    image_path = report_image(subject, config)
+    create_sleep_statistics_pdf(subject, stat_rus, subject_files(config, subject)["pdf"], image_path, config["font"])
+    return subject, stat_rus, image_path
+
+def run_report(config, subjects, stats=None, from_store=False, jobs=1, combined=False):
+    # PDF reports of the subjects, with the statistics of `stats` (e.g. returned by run_stats) when given
+    stats = None if stats is None else {subject: stat.to_dict() for subject, stat in stats.iterrows()}
+    results = run_subjects(partial(report_subject, config=config, stats=stats, from_store=from_store),
+                           subjects, jobs)
+
+    pages = [result for result in results if result is not None]
+    if combined and pages:
+        # One document: the font is registered and subset once for the whole cohort
+        pdf = new_report(config["font"])
+        for page in pages:
+            add_report_page(pdf, *page)
+        filename = os.path.join(config["pdf"], "cohort_sleep_statistics.pdf")
+        pdf.output(filename)
+        print(f"{filename} создан")
+    return pages
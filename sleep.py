@@ -0,0 +1,98 @@
+#Single entry point of the pipeline:
+#python sleep.py run stage metrics stats report --config sleep.json --first 1 --last 154 --jobs 4
+#The stages are run in this order within one process: the hypnograms of stage go to metrics and stats
+#and the statistics of stats go to report in memory instead of through the intermediate files.
+#Folders are taken from the JSON config, see pipeline.load_config and sleep.example.json
+#--run-log run_log.jsonl records every stage of every subject, python sleep.py summary run_log.jsonl
+#shows the slowest stages and subjects
+#bands averages the band power of every epoch by the doctor's and YASA stages into cohort_store/bandpower
+
+import argparse
+import warnings
+warnings.filterwarnings("ignore")
+from functions import (add_manifest_arguments, add_render_arguments, add_instrumentation_arguments,
+                       add_staging_arguments, staging_channels, configure_instrumentation, run_log_summary)
+from pipeline import load_config, select_subjects, run_stage, run_metrics, run_stats, run_bands, run_report
+
+STAGES = ["stage", "metrics", "stats", "bands", "report"]
+
+def sleep_arguments():
+    parser = argparse.ArgumentParser(description="Sleep staging pipeline: YASA vs doctor's annotations")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run the stages of the pipeline")
+    run.add_argument("stages", nargs="+", choices=STAGES, help="stages to run (always in the order " +
+                     " ".join(STAGES) + ")")
+    run.add_argument("--config", help="JSON config with the folders (default: sleep.json if present)")
+    run.add_argument("--jobs", type=int, default=1,
+                     help="number of worker processes (subjects processed in parallel)")
+    run.add_argument("--first", type=int, default=1, help="first subject index (SN001 = 1)")
+    run.add_argument("--last", type=int, default=154, help="last subject index (SN154 = 154)")
+    run.add_argument("--subjects", nargs="+", help="subjects to process (e.g. SN001 SN002), instead of --first/--last")
+    run.add_argument("--glob", help="process the recordings of the data folder matching the pattern (e.g. 'SN00*')")
+    add_manifest_arguments(run)
+    add_render_arguments(run)
+    add_instrumentation_arguments(run)
+    add_staging_arguments(run)
+    run.add_argument("--from-store", action="store_true",
+                     help="metrics, stats and report take their inputs from the cohort store")
+    run.add_argument("--annotations", action="store_true",
+                     help="stage also writes the {subject}_annotations_*.csv and _metrics_report_yasa.txt text files")
+    run.add_argument("--parquet", action="store_true", help="also save the metrics table as Parquet")
+    run.add_argument("--bootstrap", type=int, default=10000, help="subject-level bootstrap resamples (0 - none)")
+    run.add_argument("--block-bootstrap", type=int, default=0,
+                     help="epoch-block bootstrap resamples (0 - none), computed in --jobs processes")
+    run.add_argument("--block-epochs", type=int, default=20, help="epochs per block of the epoch-block bootstrap")
+    run.add_argument("--seed", type=int, default=0, help="seed of the bootstrap and of the random baseline")
+    run.add_argument("--random-baseline", action="store_true",
+                     help="also compute the chance level of the metrics (Random_baseline_yasa.xlsx)")
+    run.add_argument("--bandpower-method", choices=["welch", "multitaper"], default="welch",
+                     help="spectrum of the band power of every epoch: Welch (4-sec segments) or the multitaper "
+                          "spectrogram of the stage step")
+    run.add_argument("--combined", action="store_true",
+                     help="also write all the reports into cohort_sleep_statistics.pdf")
+    summary = commands.add_parser("summary", help="slowest stages and subjects of a run log")
+    summary.add_argument("run_log", help="JSONL file of --run-log")
+    summary.add_argument("--top", type=int, default=10, help="number of subjects and records shown")
+    return parser
+
+def run(args):
+    configure_instrumentation(args.run_log, args.profile_dir)
+    config = load_config(args.config)
+    subjects = args.subjects or select_subjects(config, args.first, args.last, args.glob)
+    # Staged subjects hand their hypnograms over, the up to date ones are read by the next stages
+    labels, stats = None, None
+    metrics_subjects, from_store = subjects, args.from_store
+    if "stage" in args.stages:
+        labels, fresh = run_stage(config, subjects, args.jobs, args.render_jobs, args.preset, args.force,
+                                  args.resume, staging_channels(args), args.annotations)
+        # Only the subjects skipped by stage (up to date) are read from the cohort store, the failed ones
+        # have no hypnograms there (or stale ones)
+        metrics_subjects = [subject for subject in subjects if subject in labels or subject in fresh]
+        from_store = True
+    if "metrics" in args.stages:
+        run_metrics(config, metrics_subjects, labels, from_store, args.jobs, args.render_jobs, args.preset,
+                    args.bootstrap, args.block_bootstrap, args.block_epochs, args.seed, args.parquet,
+                    args.random_baseline, staging_channels(args))
+    if "stats" in args.stages:
+        stats = run_stats(config, subjects, labels, args.from_store, args.jobs, staging_channels(args))
+    if "bands" in args.stages:
+        run_bands(config, subjects, args.jobs, staging_channels(args), args.bandpower_method)
+    if "report" in args.stages:
+        run_report(config, subjects, stats, args.from_store, args.jobs, args.combined)
+
+def summary(args):
+    stages, subjects, slowest = run_log_summary(args.run_log, args.top)
+    print("Этапы (секунды):")
+    print(stages.round(3).to_string())
+    print("\nСамые медленные субъекты (секунды):")
+    print(subjects.round(3).to_string())
+    print("\nСамые медленные этапы субъектов:")
+    print(slowest.round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    args = sleep_arguments().parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "summary":
+        summary(args)